@@ -0,0 +1,134 @@
+from typing import Awaitable, Callable
+
+from constant import ALERT_COOLDOWN
+from db import get_price_record, get_user_setting, list_alert_rules, insert_alert_rule, delete_alert_rule
+from type import AlertRule
+from utils import now
+
+ALERT_KINDS = ('near_max', 'near_min', 'below_buy', 'reversal')
+# the windows min and max prices are stored for
+ALERT_LENGTHS = ('3M', '1Y', '3Y')
+# (guild id or None, messages of the rules added in that guild)
+Notify = Callable[[int | None, list[str]], Awaitable[None]]
+
+
+class AlertEngine:
+    """Rules indexed by symbol (plus global rules), evaluated only for symbols whose price changed.
+
+    Everything a rule reads comes from the in-memory price cache, so a tick costs a few dict
+    lookups per rule. A rule fires when its condition becomes true, then stays quiet until the
+    condition has cleared and the cooldown has passed."""
+
+    def __init__(self, cooldown: int = ALERT_COOLDOWN):
+        self.cooldown = cooldown
+        self.rules: dict[int, AlertRule] = {}
+        self.by_code: dict[str, list[AlertRule]] = {}
+        self.global_rules: list[AlertRule] = []
+        self.active: set[tuple[int, str]] = set()
+        self.fired_at: dict[tuple[int, str], int] = {}
+        self.roots: dict[str, float] = {}
+        self.notify: Notify | None = None
+
+    def load(self) -> None:
+        self.rules = {rule['id']: rule for rule in list_alert_rules()}
+        self.reindex()
+
+    def reindex(self) -> None:
+        self.by_code, self.global_rules = {}, []
+        for rule in self.rules.values():
+            if rule['code']:
+                self.by_code.setdefault(rule['code'], []).append(rule)
+            else:
+                self.global_rules.append(rule)
+
+    def add(self, rule: AlertRule) -> AlertRule:
+        if rule['kind'] not in ALERT_KINDS:
+            raise ValueError(f"Invalid alert kind: {rule['kind']}")
+        if rule['kind'] in ('near_max', 'near_min') and (not rule['length'] or rule['threshold'] is None):
+            raise ValueError(f"{rule['kind']} needs a length and a threshold")
+        if rule['length'] and rule['length'] not in ALERT_LENGTHS:
+            raise ValueError(f"Invalid alert length: {rule['length']}, expected one of {', '.join(ALERT_LENGTHS)}")
+        rule = insert_alert_rule(rule)
+        self.rules[rule['id']] = rule
+        self.reindex()
+        return rule
+
+    def guild_rules(self, guild_id: int | None) -> list[AlertRule]:
+        """Rules added in `guild_id`, plus the ones from before rules had a guild (guild_id None)."""
+        return [rule for rule in self.rules.values() if rule['guild_id'] in (guild_id, None)]
+
+    def remove(self, rule_id: int, guild_id: int | None) -> bool:
+        rule = self.rules.get(rule_id)
+        if not rule or rule not in self.guild_rules(guild_id):
+            return False
+        removed = delete_alert_rule(rule_id)
+        del self.rules[rule_id]
+        self.reindex()
+        return removed
+
+    def evaluate(self, code: str, price: float,
+                 buy_prices: dict[int, dict[str, float]]) -> list[tuple[AlertRule, str]]:
+        """(rule, message) for every rule that fires, `buy_prices` maps a user to their holdings' buy prices."""
+        messages = []
+        for rule in (*self.by_code.get(code, ()), *self.global_rules):
+            key = (rule['id'], code)
+            message = self.check(rule, code, price, buy_prices)
+            if message is None:
+                self.active.discard(key)
+                continue
+            if key in self.active or now() - self.fired_at.get(key, 0) < self.cooldown:
+                continue
+            self.active.add(key)
+            self.fired_at[key] = now()
+            messages.append((rule, message))
+
+        root = get_price_record(code, 'root', None)
+        if root:
+            self.roots[code] = root['price']
+        return messages
+
+    def check(self, rule: AlertRule, code: str, price: float, buy_prices: dict[int, dict[str, float]]) -> str | None:
+        kind, length, threshold = rule['kind'], rule['length'], rule['threshold']
+        if kind == 'near_max':
+            record = get_price_record(code, 'max', length)
+            if record and (record['price'] - price) / price * 100 <= threshold:
+                return f"{code} {price:.2f} is within {threshold:g}% of its {length} max {record['price']:.2f}"
+        elif kind == 'near_min':
+            record = get_price_record(code, 'min', length)
+            if record and (price - record['price']) / record['price'] * 100 <= threshold:
+                return f"{code} {price:.2f} is within {threshold:g}% of its {length} min {record['price']:.2f}"
+        elif kind == 'below_buy':
+            buy_price = buy_prices.get(rule['user_id'], {}).get(code)
+            if buy_price and price < buy_price:
+                return f"{code} {price:.2f} fell below the buy price {buy_price:.2f}"
+        elif kind == 'reversal':
+            root = get_price_record(code, 'root', None)
+            previous = self.roots.get(code)
+            if root and previous is not None and root['price'] != previous:
+                return f"{code} reversed at {root['price']:.2f}, last {price:.2f}"
+        return None
+
+    async def on_ticks(self, changed: dict[str, float]) -> None:
+        # below_buy compares against the holdings of the account of whoever added the rule
+        users = {rule['user_id'] for rule in self.rules.values() if rule['kind'] == 'below_buy'}
+        buy_prices = {user: {stock['code']: stock['buy_price'] for stock in get_user_setting('own_list', user) or []}
+                      for user in users}
+        by_guild: dict[int | None, list[str]] = {}
+        for code, price in changed.items():
+            for rule, message in self.evaluate(code, price, buy_prices):
+                by_guild.setdefault(rule['guild_id'], []).append(message)
+        if self.notify:
+            for guild_id, messages in by_guild.items():
+                await self.notify(guild_id, messages)
+
+
+def format_rule(rule: AlertRule) -> str:
+    parts = [f"#{rule['id']}", rule['code'] or '*', rule['kind']]
+    if rule['length']:
+        parts.append(rule['length'])
+    if rule['threshold'] is not None:
+        parts.append(f"{rule['threshold']:g}%")
+    return ' '.join(parts)
+
+
+alert_engine = AlertEngine()
@@ -0,0 +1,227 @@
+import asyncio
+import hashlib
+import json
+import time
+from typing import Any, Callable, Mapping
+
+import aiohttp
+
+from cache import LRUCache, MISSING
+from constant import TIME_OUT, MAX_CONNECTIONS_PER_HOST, MAX_RETRIES, RETRY_BACKOFF, DELAY, RATE_LIMITS, \
+    DEFAULT_RATE_LIMIT, HTTP_CACHE_FAMILIES, HTTP_CACHE_MAX_AGE, HTTP_CACHE_SIZE, endpoint_family
+from db import get_http_cache_entry, upsert_http_cache_entry, update_http_cache_expiry
+from market import market_open, next_session_start
+from metrics import metrics
+from utils import now
+
+NETWORK_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Allows `burst` requests at once, then one every `interval` seconds."""
+
+    def __init__(self, interval: float, burst: int):
+        self.interval = interval
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            while True:
+                current = time.monotonic()
+                if self.interval > 0:
+                    self.tokens = min(self.burst, self.tokens + (current - self.updated) / self.interval)
+                else:
+                    self.tokens = self.burst
+                self.updated = current
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) * self.interval)
+
+
+_session: aiohttp.ClientSession | None = None
+_session_loop: asyncio.AbstractEventLoop | None = None
+# loop-bound state, reset together with the session
+_buckets: dict[str, TokenBucket] = {}
+_in_flight: dict[tuple[str, str | None, Callable], asyncio.Task] = {}
+# (url, parser) -> validators, body digest and parsed body (MISSING until needed) of the http_cache row, so
+# fresh hits never read the db
+response_cache = LRUCache(HTTP_CACHE_SIZE)
+metrics.watch_cache('http_responses', response_cache)
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Shared keep-alive session, recreated when the running event loop changes."""
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(limit_per_host=MAX_CONNECTIONS_PER_HOST, ttl_dns_cache=300)
+        _session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=TIME_OUT))
+        _session_loop = loop
+        _buckets.clear()
+        _in_flight.clear()
+    return _session
+
+
+async def close_session() -> None:
+    global _session
+    if _session and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def get_bucket(url: str) -> TokenBucket:
+    family = endpoint_family(url)
+    if family not in _buckets:
+        multiple, burst = RATE_LIMITS.get(family, DEFAULT_RATE_LIMIT)
+        _buckets[family] = TokenBucket(DELAY * multiple, burst)
+    return _buckets[family]
+
+
+async def request(method: str, url: str, **kwargs) -> tuple[int, Mapping[str, str], bytes]:
+    session = get_session()
+    family = endpoint_family(url)
+    for attempt in range(MAX_RETRIES + 1):
+        await get_bucket(url).acquire()
+        try:
+            with metrics.span('http.request', family=family):
+                async with session.request(method, url, **kwargs) as response:
+                    metrics.count('http.requests', family=family, status=str(response.status))
+                    if response.status in RETRY_STATUS and attempt < MAX_RETRIES:
+                        raise aiohttp.ClientResponseError(response.request_info, (), status=response.status)
+                    body = await response.read()
+            metrics.count('http.bytes', len(body), family=family)
+            return response.status, response.headers, body
+        except NETWORK_ERRORS:
+            metrics.count('http.errors', family=family)
+            if attempt == MAX_RETRIES:
+                raise
+        await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+
+def parse_json(body: bytes) -> Any:
+    if not body:
+        return None
+    with metrics.span('json.parse'):
+        return json.loads(body)
+
+
+async def request_json(method: str, url: str, **kwargs) -> Any:
+    _, _, body = await request(method, url, **kwargs)
+    return parse_json(body)
+
+
+def cache_expiry() -> int:
+    """Charts only move while the market is open, outside a session (the lunch break included) a body stays
+    valid until the next one starts."""
+    current = now()
+    if market_open(current):
+        return current + HTTP_CACHE_MAX_AGE
+    return next_session_start(current)
+
+
+def load_cached_response(url: str, parse: Callable[[bytes], Any] = parse_json) -> dict | None:
+    """The stored body is parsed right away only when it is still fresh, an expired one waits for
+    the revalidation to tell whether it is needed at all."""
+    entry = response_cache.get((url, parse))
+    if entry is MISSING:
+        row = get_http_cache_entry(url)
+        entry = None
+        if row:
+            entry = {
+                'etag': row['etag'], 'last_modified': row['last_modified'], 'expiry': row['expiry'],
+                'digest': hashlib.sha1(row['body']).hexdigest(),
+                'parsed': parse(row['body']) if row['expiry'] > now() else MISSING,
+            }
+        response_cache.put((url, parse), entry)
+    return entry
+
+
+def cached_parsed(url: str, entry: dict, parse: Callable[[bytes], Any]) -> Any:
+    """The parsed body of a revalidated entry, read back from the db if it was never needed before.
+    MISSING once the row has been deleted meanwhile."""
+    if entry['parsed'] is MISSING:
+        row = get_http_cache_entry(url)
+        if row is None:
+            return MISSING
+        entry['parsed'] = parse(row['body'])
+    return entry['parsed']
+
+
+async def cached_get(url: str, parse: Callable[[bytes], Any] = parse_json) -> Any:
+    """GET through the on-disk http cache: fresh entries are served without a request, stale ones are
+    revalidated with If-None-Match / If-Modified-Since, and a body identical to the cached one is not parsed again."""
+    entry = load_cached_response(url, parse)
+    if entry and entry['expiry'] > now():
+        metrics.count('http_cache', result='fresh')
+        return entry['parsed']
+
+    headers = {}
+    if entry and entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    status, response_headers, body = await request('GET', url, headers=headers)
+
+    expiry = cache_expiry()
+    if status == 304 and entry:
+        parsed = cached_parsed(url, entry, parse)
+        if parsed is MISSING:
+            # pruned by upsert_http_cache_entry since it was loaded, download the body again
+            response_cache.pop((url, parse))
+            return await cached_get(url, parse)
+        metrics.count('http_cache', result='not_modified')
+        entry['expiry'] = expiry
+        update_http_cache_expiry(url, expiry)
+        return parsed
+    if status != 200:
+        return parse(body)
+
+    digest = hashlib.sha1(body).hexdigest()
+    unchanged = entry and entry['digest'] == digest
+    metrics.count('http_cache', result='unchanged' if unchanged else 'downloaded')
+    parsed = entry['parsed'] if unchanged and entry['parsed'] is not MISSING else parse(body)
+    etag, last_modified = response_headers.get('ETag'), response_headers.get('Last-Modified')
+    upsert_http_cache_entry(url, body, etag, last_modified, expiry)
+    response_cache.put((url, parse), {'etag': etag, 'last_modified': last_modified, 'expiry': expiry, 'digest': digest, 'parsed': parsed})
+    return parsed
+
+
+async def fetch(url: str, headers: dict | None = None, parse: Callable[[bytes], Any] = parse_json) -> Any:
+    if not headers and endpoint_family(url) in HTTP_CACHE_FAMILIES:
+        return await cached_get(url, parse)
+    _, _, body = await request('GET', url, headers=headers)
+    return parse(body)
+
+
+async def get(url: str, headers: dict | None = None, parse: Callable[[bytes], Any] = parse_json) -> Any:
+    """GET a body decoded by `parse`. Identical GETs already in flight share one request and its parsed
+    body, which callers must not mutate."""
+    get_session()
+    key = (url, (headers or {}).get('Authorization'), parse)
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.get_running_loop().create_task(fetch(url, headers, parse))
+        _in_flight[key] = task
+        task.add_done_callback(lambda done: finish_in_flight(key, done))
+    return await asyncio.shield(task)
+
+
+async def get_json(url: str, headers: dict | None = None) -> Any:
+    return await get(url, headers)
+
+
+def finish_in_flight(key: tuple[str, str | None, Callable], task: asyncio.Task) -> None:
+    if _in_flight.get(key) is task:
+        del _in_flight[key]
+    if not task.cancelled():
+        # mark the exception retrieved, the awaiting callers re-raise it themselves
+        task.exception()
+
+
+async def post_json(url: str, json: dict) -> Any:
+    return await request_json('POST', url, json=json)
@@ -1,27 +1,97 @@
-import requests
-from constant import TIME_OUT, VP_USERNAME, VP_PASSWORD, get_url
+import asyncio
+
+from api import post_json, NETWORK_ERRORS
+from constant import TOKEN_RENEW_MARGIN, DEFAULT_USER, get_url
 from type import AuthToken
 from utils import safe_access, now
-from db import db
+from db import get_auth_token_record, update_auth_token_record, get_user
+
+
+class TokenManager:
+    """Keeps one user's access token in memory. Concurrent callers share one in-flight login, and the token
+    is renewed in the background `margin` seconds before it expires."""
+
+    def __init__(self, user: int = DEFAULT_USER, margin: int = TOKEN_RENEW_MARGIN):
+        self.user = user
+        self.margin = margin
+        self.token: AuthToken | None = None
+        self._refreshing: asyncio.Task | None = None
+        self._renewal: asyncio.Task | None = None
+
+    async def get_token(self) -> str:
+        if self.token is None:
+            self.token = get_auth_token_record(self.user)
+        if valid_token(self.token):
+            if self._renewal is None or self._renewal.done():
+                self.schedule_renewal()
+            return self.token['token']
+        return (await self.refresh())['token']
+
+    async def refresh(self) -> AuthToken:
+        loop = asyncio.get_running_loop()
+        if self._refreshing is None or self._refreshing.done() or self._refreshing.get_loop() is not loop:
+            self._refreshing = loop.create_task(self._refresh())
+        return await asyncio.shield(self._refreshing)
+
+    async def _refresh(self) -> AuthToken:
+        auth_token = await fetch_auth_token(self.user)
+        update_auth_token_record(auth_token, self.user)
+        self.token = auth_token
+        self.schedule_renewal()
+        return auth_token
+
+    def schedule_renewal(self) -> None:
+        if self._renewal and not self._renewal.done():
+            self._renewal.cancel()
+        remaining = self.token['expiry'] - now()
+        # halfway through tokens that live shorter than the margin, so renewal never spins
+        delay = max(remaining - self.margin, remaining // 2, 0)
+        self._renewal = asyncio.get_running_loop().create_task(self._renew_after(delay))
+
+    async def _renew_after(self, delay: int) -> None:
+        await asyncio.sleep(delay)
+        try:
+            await self.refresh()
+        except (*NETWORK_ERRORS, ValueError) as error:
+            # the next get_token call logs in again once the token is no longer valid
+            print(f'Token renewal failed for user {self.user}: {error}')
+
+    def stop(self) -> None:
+        for task in (self._refreshing, self._renewal):
+            if task and not task.done():
+                task.cancel()
+
+
+token_managers: dict[int, TokenManager] = {}
+
+
+def get_token_manager(user: int = DEFAULT_USER) -> TokenManager:
+    if user not in token_managers:
+        token_managers[user] = TokenManager(user)
+    return token_managers[user]
+
 
+def forget_token_manager(user: int) -> None:
+    """Called when a user's credentials change or are removed."""
+    manager = token_managers.pop(user, None)
+    if manager:
+        manager.stop()
 
-def get_auth_token():
-    auth_token = db.table('auth').get(doc_id=1)
-    if not valid_token(auth_token):
-        auth_token = fetch_auth_token()
-        db.table('auth').update(auth_token, doc_ids=[1])
 
-    return auth_token['token']
+async def get_auth_token(user: int = DEFAULT_USER):
+    return await get_token_manager(user).get_token()
 
 
 def valid_token(auth_token: dict) -> bool:
-    return auth_token['token'] and auth_token['expiry'] > now()
+    return bool(auth_token['token']) and auth_token['expiry'] > now()
 
 
-def fetch_auth_token() -> AuthToken:
+async def fetch_auth_token(user: int = DEFAULT_USER) -> AuthToken:
+    credentials = get_user(user)
+    if not credentials:
+        raise ValueError(f"Unknown user {user}")
     url = get_url('login')
-    response = requests.post(url, json={'username': VP_USERNAME, 'password': VP_PASSWORD}, timeout=TIME_OUT)
-    parsed = response.json()
+    parsed = await post_json(url, json={'username': credentials['username'], 'password': credentials['password']})
 
     access_token = safe_access(parsed, ['data', 'access_token'])
     expires_in = safe_access(parsed, ['data', 'expires_in'])
@@ -31,5 +101,5 @@ def fetch_auth_token() -> AuthToken:
     return {'token': access_token, 'expiry': expires_in + now()}
 
 
-def get_auth_headers() -> dict:
-    return {'Authorization': f'Bearer {get_auth_token()}'}
+async def get_auth_headers(user: int = DEFAULT_USER) -> dict:
+    return {'Authorization': f'Bearer {await get_auth_token(user)}'}
@@ -0,0 +1,245 @@
+"""Offline benchmark of the !ssl / !sol paths and the services behind them, against mock_server.py.
+
+Every scenario runs at each symbol count with a throwaway db and history directory. Cold scenarios start
+from an empty db every run, warm ones are primed once first. Reported per scenario: latency percentiles,
+upstream requests per endpoint family, bytes downloaded, db statements and Discord messages sent.
+
+    python bench.py                                  # 10, 100 and 1000 symbols
+    python bench.py --sizes 100 --latency 0.05 --runs 10
+    python bench.py --json > baseline.json
+    python bench.py --baseline baseline.json         # exit status 1 on a regression
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+SIZES = (10, 100, 1000)
+PERCENTILES = (50, 90, 99)
+
+
+def configure(workdir: str, port: int, delay: float) -> None:
+    """Point the bot at the mock server and the throwaway directory. Must run before any bot module is
+    imported, they read these once at import time."""
+    os.environ.update({
+        'BASE_URL': f'http://127.0.0.1:{port}',
+        'DB_NAME': os.path.join(workdir, 'db.sqlite3'),
+        'HISTORY_DIR': os.path.join(workdir, 'history'),
+        'DELAY': str(delay),
+        'VP_USERNAME': 'bench',
+        'VP_PASSWORD': 'bench',
+        'REFRESH_INTERVAL': '0',
+        'REALTIME_INTERVAL': '0',
+    })
+
+
+class FakeMessage:
+    def __init__(self, channel: 'FakeChannel', content: str):
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content: str) -> 'FakeMessage':
+        self.content = content
+        self.channel.edits += 1
+        return self
+
+    async def delete(self) -> None:
+        self.channel.deletes += 1
+
+
+class FakeChannel:
+    """Stands in for a discord channel or command context: send_table only needs `id` and `send`."""
+
+    id = 0
+
+    def __init__(self):
+        self.sent: list[FakeMessage] = []
+        self.edits = 0
+        self.deletes = 0
+
+    async def send(self, content: str) -> FakeMessage:
+        message = FakeMessage(self, content)
+        self.sent.append(message)
+        return message
+
+
+class DbTrace:
+    """Counts the statements sqlite runs, through sqlite3.Connection.set_trace_callback."""
+
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+
+    def __call__(self, statement: str) -> None:
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+        if verb == 'SELECT':
+            self.reads += 1
+        elif verb in ('INSERT', 'UPDATE', 'DELETE', 'REPLACE'):
+            self.writes += 1
+
+
+def reset_state(workdir: str) -> None:
+    """Forget everything a previous run left in memory or on disk, as after a fresh install."""
+    import api
+    import auth
+    import db
+    import render
+    import services
+    from constant import DEFAULT_USER
+
+    if db._connection is not None:
+        db._connection.close()
+        db._connection = None
+    for name in os.listdir(workdir):
+        path = os.path.join(workdir, name)
+        shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+    for cache in (db.price_cache, db.settings_cache, db.history_cache, api.response_cache):
+        cache.clear()
+    services.history_store.series.clear()
+    render.posted_tables.clear()
+    auth.forget_token_manager(DEFAULT_USER)
+    db.init_db()
+
+
+def scenarios() -> list[tuple[str, bool, callable]]:
+    """(name, cold, run(codes, channel)) for every measured path."""
+    import main
+    import services
+
+    async def single_chart(codes, channel):
+        await services.fetch_price_history(codes[0], '3Y')
+
+    async def min_max(codes, channel):
+        for code in codes:
+            for length in ('3M', '1Y', '3Y'):
+                await services.get_min_max_price(code, length)
+
+    async def complete(show, channel):
+        # time until the table is final, including the edit of a table first posted with stale prices
+        await show(channel)
+        await asyncio.gather(*main.background_tasks)
+
+    return [
+        ('show_summary', True, lambda codes, channel: complete(main.show_summary, channel)),
+        ('show_summary', False, lambda codes, channel: complete(main.show_summary, channel)),
+        ('show_own_list', True, lambda codes, channel: complete(main.show_own_list, channel)),
+        ('show_own_list', False, lambda codes, channel: complete(main.show_own_list, channel)),
+        ('prefetch_prices', True, lambda codes, channel: services.prefetch_prices(codes)),
+        ('fetch_realtime_prices', False, lambda codes, channel: services.fetch_realtime_prices(codes)),
+        ('fetch_price_history 3Y', False, single_chart),
+        ('get_min_max_price', False, min_max),
+    ]
+
+
+async def measure(server, workdir: str, codes: list[str], cold: bool, run, runs: int) -> dict:
+    import db
+
+    if not cold:
+        reset_state(workdir)
+        await run(codes, FakeChannel())
+    timings, trace, channel = [], DbTrace(), FakeChannel()
+    server.reset_counters()
+    for _ in range(runs):
+        if cold:
+            reset_state(workdir)
+        db.get_connection().set_trace_callback(trace)
+        start = time.perf_counter()
+        await run(codes, channel)
+        timings.append(time.perf_counter() - start)
+        db.get_connection().set_trace_callback(None)
+
+    return {
+        **{f'p{percentile}': float(np.percentile(timings, percentile)) * 1000 for percentile in PERCENTILES},
+        'max': max(timings) * 1000,
+        'requests': {family: count / runs for family, count in sorted(server.requests.items())},
+        'kb': server.bytes_sent / runs / 1024,
+        'db_reads': trace.reads / runs,
+        'db_writes': trace.writes / runs,
+        'messages': len(channel.sent) / runs,
+    }
+
+
+async def run_benchmark(args) -> dict:
+    from api import close_session
+    from mock_server import MockServer, symbol_names
+
+    results = {}
+    for size in args.sizes:
+        codes = symbol_names(size)
+        server = MockServer(codes, args.latency, args.fixtures, port=args.port)
+        server.start()
+        try:
+            for name, cold, run in scenarios():
+                key = f"{size} {name} {'cold' if cold else 'warm'}"
+                results[key] = await measure(server, args.workdir, codes, cold, run, args.runs)
+                if not args.json:
+                    print_result(key, results[key])
+        finally:
+            await close_session()
+            server.stop()
+    return results
+
+
+def print_result(key: str, result: dict) -> None:
+    requests = ', '.join(f'{family} {count:g}' for family, count in result['requests'].items()) or 'none'
+    print(f"{key:<40} p50 {result['p50']:8.1f}ms  p90 {result['p90']:8.1f}ms  p99 {result['p99']:8.1f}ms  "
+          f"max {result['max']:8.1f}ms  {result['kb']:9.1f}KB  db {result['db_reads']:g}r/{result['db_writes']:g}w  "
+          f"msgs {result['messages']:g}  requests: {requests}")
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Slower p50 beyond `tolerance`, or any more upstream requests or db statements than the baseline."""
+    found = []
+    for key, result in results.items():
+        before = baseline.get(key)
+        if not before:
+            continue
+        if result['p50'] > before['p50'] * (1 + tolerance):
+            found.append(f"{key}: p50 {before['p50']:.1f}ms -> {result['p50']:.1f}ms")
+        if sum(result['requests'].values()) > sum(before['requests'].values()):
+            found.append(f"{key}: requests {sum(before['requests'].values()):g} -> {sum(result['requests'].values()):g}")
+        for field in ('db_reads', 'db_writes'):
+            if result[field] > before[field]:
+                found.append(f'{key}: {field} {before[field]:g} -> {result[field]:g}')
+    return found
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='symbol counts to run at')
+    parser.add_argument('--runs', type=int, default=5, help='measured runs per scenario')
+    parser.add_argument('--latency', type=float, default=0.02, help='mock server seconds per response')
+    parser.add_argument('--delay', type=float, default=0.0, help='DELAY for the rate limiter, 0 disables it')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--fixtures', help='directory of recorded responses, see mock_server.py')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    parser.add_argument('--baseline', help='json results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p50 slowdown against the baseline')
+    args = parser.parse_args()
+
+    args.workdir = tempfile.mkdtemp(prefix='stock-bench-')
+    configure(args.workdir, args.port, args.delay)
+    try:
+        results = asyncio.run(run_benchmark(args))
+    finally:
+        shutil.rmtree(args.workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            found = regressions(results, json.load(file), args.tolerance)
+        for line in found:
+            print(f'REGRESSION {line}', file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
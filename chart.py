@@ -0,0 +1,62 @@
+import json
+from array import array
+from functools import lru_cache
+
+from metrics import metrics
+from utils import convert_date_to_timestamp
+
+# HISTORY_DTYPE column -> getPriceChartLine key, TradingDate and ClosePrice are required
+CHART_KEYS = {'open': 'OpenPrice', 'high': 'HighestPrice', 'low': 'LowestPrice', 'close': 'ClosePrice',
+              'volume': 'TotalVolume'}
+NAN = float('nan')
+
+
+@lru_cache(maxsize=4096)
+def trading_timestamp(date: str) -> int:
+    """Every symbol's chart repeats the same trading dates, so each date string is parsed once."""
+    return convert_date_to_timestamp(date)
+
+
+class ChartColumns:
+    """Column buffers of one chart in response order: the timestamp in an array('q'),
+    each price field in an array('d') (nan where the response has no value)."""
+
+    __slots__ = ('timestamps', 'open', 'high', 'low', 'close', 'volume', '_appends')
+
+    def __init__(self):
+        self.timestamps = array('q')
+        for field in CHART_KEYS:
+            setattr(self, field, array('d'))
+        self._appends = tuple((key, getattr(self, field).append) for field, key in CHART_KEYS.items())
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def add(self, price: dict) -> None:
+        if not isinstance(price, dict):
+            raise ValueError("Invalid response: PriceHistory row is not an object")
+        trading_date = price.get('TradingDate')
+        if price.get('ClosePrice') is None or trading_date is None:
+            missing_key = 'ClosePrice' if price.get('ClosePrice') is None else 'TradingDate'
+            raise ValueError(f"Invalid response key: {missing_key}")
+        self.timestamps.append(trading_timestamp(trading_date))
+        for key, append in self._appends:
+            value = price.get(key)
+            # float() also takes numeric strings, and raises ValueError on anything else
+            append(NAN if value is None else float(value))
+
+
+def decode_price_history(body: bytes) -> ChartColumns:
+    """Parse a getPriceChartLine body and copy its PriceHistory rows into column buffers,
+    empty when the response has no PriceHistory."""
+    columns = ChartColumns()
+    with metrics.span('chart.decode'):
+        parsed = json.loads(body) if body else None
+        prices = parsed.get('PriceHistory') if isinstance(parsed, dict) else None
+        if prices is None:
+            return columns
+        if not isinstance(prices, list):
+            raise ValueError("Invalid response: PriceHistory is not a list")
+        for price in prices:
+            columns.add(price)
+    return columns
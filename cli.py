@@ -0,0 +1,99 @@
+"""Query prices without the Discord bot, for cron jobs and scripts.
+
+    python cli.py summary              # the !ssl table
+    python cli.py own                  # the !sol table
+    python cli.py portfolio --json     # the !pf figures as json
+    python cli.py price VNM FPT --json
+    python cli.py scan                 # the !scan ranking, matches streamed to stderr as they arrive
+
+Options may come before or after the symbols. Only --help and argument errors return before the bot modules
+are imported; every command loads them, aiohttp, numpy and the metrics registry included.
+"""
+import argparse
+import asyncio
+import json
+import sys
+
+COMMANDS = ('summary', 'own', 'portfolio', 'price', 'scan')
+
+
+async def load(command: str, codes: list[str], user: int):
+    """(json data, table, title) for a command."""
+    import formatting
+    import services
+
+    if command == 'summary':
+        rows = await services.watch_list_summary(user)
+        return rows, formatting.summary_table(rows), formatting.summary_title()
+    if command == 'own':
+        rows = await services.own_list_summary(user)
+        return rows, formatting.own_list_table(rows), formatting.own_list_title()
+    if command == 'portfolio':
+        from portfolio import load_portfolio
+        portfolio = await load_portfolio(user=user)
+        return portfolio.to_dict(), formatting.portfolio_table(portfolio), formatting.portfolio_title()
+
+    await services.prefetch_prices(codes)
+    rows = [await services.price_summary(code) for code in codes]
+    return rows, formatting.summary_table(rows), ''
+
+
+async def scan(codes: list[str], threshold: float | None, as_json: bool):
+    """Each match goes to stderr the moment it is found (one json object per line with --json),
+    the final ranking is returned like any other command's data."""
+    import formatting
+    from scanner import Scan, load_universe
+
+    arguments = {'threshold': threshold} if threshold is not None else {}
+    current = Scan(codes or load_universe(), **arguments)
+    async for result in current.results():
+        line = json.dumps(result) if as_json else f"{result['code']} {result['score']:.1f}% {current.progress()}"
+        print(line, file=sys.stderr)
+    return current.ranking, formatting.scan_table(current.ranking), formatting.scan_title()
+
+
+async def run(args) -> int:
+    from api import close_session, NETWORK_ERRORS
+    from db import init_db
+    from render import render_rows
+
+    init_db()
+    try:
+        if args.command == 'scan':
+            data, table, title = await scan(args.codes, args.threshold, args.json)
+        else:
+            data, table, title = await load(args.command, args.codes, args.user)
+    except (*NETWORK_ERRORS, ValueError) as error:
+        print(f'{args.command} failed: {error}', file=sys.stderr)
+        return 1
+    finally:
+        await close_session()
+
+    if args.json:
+        print(json.dumps(data, indent=2))
+    elif table:
+        header, rows = render_rows(table)
+        print('\n'.join((title, header, *rows)) if title else '\n'.join((header, *rows)))
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('codes', nargs='*', help='symbols for the price command, or to scan instead of the universe')
+    parser.add_argument('--json', action='store_true', help='print machine-readable json instead of a table')
+    parser.add_argument('--threshold', type=float, help='scan: percent above a low that counts as near it')
+    parser.add_argument('--user', type=int, default=0, help='registered user id, 0 for the .env account')
+    args = parser.parse_intermixed_args()
+    if args.command == 'price' and not args.codes:
+        parser.error('price needs at least one symbol')
+    from constant import check_symbol
+    try:
+        args.codes = [check_symbol(code) for code in args.codes]
+    except ValueError as error:
+        parser.error(str(error))
+    return asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
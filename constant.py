@@ -1,16 +1,53 @@
 import os
+import re
 from dotenv import load_dotenv
 
 load_dotenv()
 
-DB_NAME = 'db.json'
-DELAY = 0.5
+DB_NAME = os.getenv('DB_NAME', 'db.sqlite3')
+LEGACY_DB_NAME = 'db.json'
+PRICE_CACHE_SIZE = 4096
+SETTINGS_CACHE_SIZE = 64
+# base interval in seconds between upstream requests of one endpoint family, see RATE_LIMITS
+DELAY = float(os.getenv('DELAY', 0.5))
 TIME_OUT = 5
+# seconds before expiry at which the auth token is renewed in the background
+TOKEN_RENEW_MARGIN = 300
+MAX_CONNECTIONS_PER_HOST = 16
+MAX_RETRIES = 2
+RETRY_BACKOFF = 0.5
+# background refresh: every REFRESH_INTERVAL seconds (0 disables) re-fetch prices expiring within REFRESH_AHEAD,
+# REFRESH_BATCH_SIZE symbols at a time with a random pause of up to REFRESH_JITTER seconds before each batch
+REFRESH_INTERVAL = int(os.getenv('REFRESH_INTERVAL', 600))
+REFRESH_AHEAD = int(os.getenv('REFRESH_AHEAD', 1800))
+REFRESH_BATCH_SIZE = int(os.getenv('REFRESH_BATCH_SIZE', 10))
+REFRESH_JITTER = float(os.getenv('REFRESH_JITTER', 2.0))
+# seconds between getPriceByList polls during trading hours, 0 disables the realtime feed
+REALTIME_INTERVAL = int(os.getenv('REALTIME_INTERVAL', 60))
+# user id of the VPBanks account configured by VP_USERNAME / VP_PASSWORD, other users register with the bot
+DEFAULT_USER = 0
 VP_USERNAME = os.getenv('VP_USERNAME')
 VP_PASSWORD = os.getenv('VP_PASSWORD')
+# Fernet key the passwords of registered users are encrypted with in the db, generate one with
+# python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"
+CREDENTIALS_KEY = os.getenv('CREDENTIALS_KEY')
 DISCORD_BOT_TOKEN = os.getenv('DISCORD_BOT_TOKEN')
 DISCORD_TEST_CHANNEL_ID = os.getenv('DISCORD_TEST_CHANNEL_ID')
-BASE_URL = 'https://external.vpbanks.com.vn'
+DISCORD_MESSAGE_LIMIT = 2000
+# seconds a table command waits for fresh prices before posting what the db holds (stale values marked),
+# the message is edited once the refresh completes
+COMMAND_BUDGET = float(os.getenv('COMMAND_BUDGET', 3))
+# watch lists longer than PAGE_SIZE are shown as pages with buttons, which stop answering after PAGE_TIMEOUT
+# seconds idle; a sorted order is reused for PAGE_ORDERING_TTL seconds
+PAGE_SIZE = 10
+PAGE_TIMEOUT = 600
+PAGE_ORDERING_TTL = 60
+# when set, metrics are written to this file in Prometheus text format every METRICS_INTERVAL seconds
+METRICS_FILE = os.getenv('METRICS_FILE')
+METRICS_INTERVAL = 60
+# seconds before the same rule may fire again for the same symbol
+ALERT_COOLDOWN = 3600
+BASE_URL = os.getenv('BASE_URL', 'https://external.vpbanks.com.vn')
 API_URL = {
     'price_chart': "/invest/api/stock/getPriceChartLine?symbol={code}&chartType={type}",
     'realtime_price': "/invest/api/getPriceByList/5min?symbolList={code}",
@@ -21,10 +58,59 @@ REQUIRED_AUTH = {
     'own_list': '/flex/inq/accounts/{account_id}/securitiesPortfolio',
     'account_list': '/flex/accountsAll',
 }
+# endpoint family -> (seconds per request as a multiple of DELAY, burst size) for the token bucket rate limiter
+RATE_LIMITS = {
+    'price_chart': (0.1, 20),
+    'realtime_price': (1, 2),
+    'login': (2, 1),
+}
+DEFAULT_RATE_LIMIT = (1, 5)
+# endpoint families whose responses are kept in the on-disk http cache. While the market is open an entry is
+# fresh for HTTP_CACHE_MAX_AGE seconds, after the close it stays fresh until the next session opens. Expired
+# entries are still revalidated with their ETag, and deleted once expired for HTTP_CACHE_RETENTION seconds
+HTTP_CACHE_FAMILIES = ('price_chart',)
+HTTP_CACHE_MAX_AGE = 60
+HTTP_CACHE_RETENTION = 86400
+# parsed bodies kept in memory, enough for a 3Y and a 1W chart of every symbol in universe.txt
+HTTP_CACHE_SIZE = 1024
+# chart downloaded the first time a symbol's history is needed, and the tail merged into it afterwards
+HISTORY_CHART_TYPE = '3Y'
+HISTORY_TAIL_TYPE = '1W'
+HISTORY_DIR = os.getenv('HISTORY_DIR', 'history')
+# rendered !chart images, named by the sha256 of their rows and overlays, the least recently served pruned
+CHART_DIR = os.getenv('CHART_DIR', 'charts')
+CHART_CACHE_SIZE = 256
+CHART_LENGTHS = ('1M', '3M', '1Y', '3Y')
+# processes charts are rendered in, default one per core
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', 0)) or None
+# whole-market scan: symbols listed in SCAN_UNIVERSE_FILE (whitespace or comma separated, # starts a comment;
+# the shipped universe.txt holds the HOSE and HNX listings) when it exists, VN30 otherwise. A symbol is reported
+# when its last close is within SCAN_NEAR_PERCENT of a 3M/1Y/3Y low or it just reversed direction
+SCAN_UNIVERSE_FILE = os.getenv('SCAN_UNIVERSE_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                   'universe.txt'))
+SCAN_NEAR_PERCENT = 5.0
+SCAN_LENGTHS = ('3M', '1Y', '3Y')
+# !scan shows the SCAN_TOP best ranked matches, editing the table at most every SCAN_UPDATE_INTERVAL seconds
+SCAN_TOP = 30
+SCAN_UPDATE_INTERVAL = 2.0
+VN30 = (
+    'ACB', 'BCM', 'BID', 'BVH', 'CTG', 'FPT', 'GAS', 'GVR', 'HDB', 'HPG', 'LPB', 'MBB', 'MSN', 'MWG', 'PLX',
+    'SAB', 'SHB', 'SSB', 'SSI', 'STB', 'TCB', 'TPB', 'VCB', 'VHM', 'VIB', 'VIC', 'VJC', 'VNM', 'VPB', 'VRE',
+)
+# getPriceByList response: the item list (unless the body is the list itself), each item's symbol and the
+# field names that may carry the latest matched price, in order of preference
+REALTIME_LIST_KEYS = ('data', 'd')
+REALTIME_SYMBOL_KEYS = ('symbol', 'Symbol')
+REALTIME_PRICE_KEYS = ('lastPrice', 'matchPrice', 'closePrice', 'ClosePrice')
+# symbols typed by users must look like this before they go into a url or a history file name
+SYMBOL_PATTERN = re.compile(r'[A-Z0-9]{3,10}')
+# shortest to longest, a longer chart contains every shorter one
 CHART_TYPE = {
     '1W': '1W',
+    '1M': '1M',
     '3M': '3M',
     '1Y': '1Y',
+    '3Y': '3Y',
 }
 
 
@@ -38,3 +124,21 @@ def get_url(name: str, auth=False) -> str:
         raise ValueError("Invalid API name")
 
     return f"{BASE_URL}{path}"
+
+
+def check_symbol(code: str) -> str:
+    """`code` upper-cased, ValueError unless it matches SYMBOL_PATTERN."""
+    code = code.upper()
+    if not SYMBOL_PATTERN.fullmatch(code):
+        raise ValueError(f"Invalid symbol: {code}")
+    return code
+
+
+def endpoint_family(url: str) -> str:
+    """Name of the API_URL / REQUIRED_AUTH entry a get_url-built url belongs to."""
+    path = url[len(BASE_URL):] if url.startswith(BASE_URL) else url
+    for name, template in (*API_URL.items(), *REQUIRED_AUTH.items()):
+        prefix = template.split('{')[0].split('?')[0]
+        if path.startswith(prefix):
+            return name
+    return 'other'
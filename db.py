@@ -1,24 +1,210 @@
-from typing import Optional
+import copy
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Optional, Any, Hashable, Iterator, TYPE_CHECKING
 
-from tinydb import TinyDB, Query
-
-from type import PriceReturn, PriceRecord, PriceType, PriceLength
+from cache import LRUCache, MISSING
+from constant import DB_NAME, LEGACY_DB_NAME, PRICE_CACHE_SIZE, SETTINGS_CACHE_SIZE, DEFAULT_USER, VP_USERNAME, \
+    VP_PASSWORD, CREDENTIALS_KEY, HTTP_CACHE_RETENTION
+from metrics import metrics
+from type import PriceReturn, PriceRecord, PriceType, PriceLength, AuthToken, HistoryRecord, AlertRule, User
 from utils import now
 
-db = TinyDB('db.json')
+if TYPE_CHECKING:
+    from cryptography.fernet import Fernet
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS prices (
+    code TEXT NOT NULL,
+    type TEXT NOT NULL,
+    length TEXT NOT NULL DEFAULT '',
+    price REAL NOT NULL,
+    expiry INTEGER
+);
+CREATE UNIQUE INDEX IF NOT EXISTS prices_code_type_length ON prices (code, type, length);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expiry INTEGER
+);
+CREATE TABLE IF NOT EXISTS history (
+    code TEXT PRIMARY KEY,
+    span TEXT NOT NULL,
+    refreshed INTEGER NOT NULL,
+    expiry INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS alert_rules (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    code TEXT,
+    kind TEXT NOT NULL,
+    length TEXT,
+    threshold REAL,
+    guild_id INTEGER,
+    user_id INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS http_cache (
+    url TEXT PRIMARY KEY,
+    body BLOB NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    expiry INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS http_cache_expiry ON http_cache (expiry);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    password TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS auth (
+    user_id INTEGER PRIMARY KEY,
+    token TEXT,
+    expiry INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS guilds (
+    id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL
+);
+"""
+# settings that belong to one VPBanks account, stored as "<name>:<user id>"
+ACCOUNT_SETTINGS = ('watch_list', 'own_list', 'account_id')
+# upgrades of an existing db file, MIGRATIONS[n] takes PRAGMA user_version from n to n + 1
+MIGRATIONS = (
+    # the single auth row and the account settings become user 0's, the account configured in .env
+    f"""
+    BEGIN;
+    CREATE TABLE auth_by_user (user_id INTEGER PRIMARY KEY, token TEXT, expiry INTEGER NOT NULL DEFAULT 0);
+    INSERT INTO auth_by_user (user_id, token, expiry) SELECT {DEFAULT_USER}, token, expiry FROM auth;
+    DROP TABLE auth;
+    ALTER TABLE auth_by_user RENAME TO auth;
+    UPDATE settings SET name = name || ':{DEFAULT_USER}' WHERE name IN {ACCOUNT_SETTINGS};
+    COMMIT;
+    """,
+    # registered passwords were stored in plain text
+    lambda connection: encrypt_stored_passwords(connection),
+    # alert rules belong to the guild they were added in and the account of the user who added them
+    f"""
+    BEGIN;
+    CREATE TABLE IF NOT EXISTS alert_rules (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, code TEXT, kind TEXT NOT NULL, length TEXT, threshold REAL
+    );
+    ALTER TABLE alert_rules ADD COLUMN guild_id INTEGER;
+    ALTER TABLE alert_rules ADD COLUMN user_id INTEGER NOT NULL DEFAULT {DEFAULT_USER};
+    COMMIT;
+    """,
+)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Times every execute as a db.query span labelled with the statement's verb."""
+
+    def execute(self, sql: str, parameters=(), /) -> sqlite3.Cursor:
+        with metrics.span('db.query', op=sql.split(None, 1)[0].lower()):
+            return super().execute(sql, parameters)
+
+
+_connection: sqlite3.Connection | None = None
+# every write goes through this module, so cached rows (and cached absences, stored as None) never go stale
+price_cache = LRUCache(PRICE_CACHE_SIZE)
+settings_cache = LRUCache(SETTINGS_CACHE_SIZE)
+history_cache = LRUCache(PRICE_CACHE_SIZE)
+metrics.watch_cache('prices', price_cache)
+metrics.watch_cache('settings', settings_cache)
+metrics.watch_cache('history', history_cache)
+# cache writes made inside transaction(), applied only once it commits
+_pending_puts: list[tuple[LRUCache, Hashable, Any]] | None = None
+
+
+def get_connection() -> sqlite3.Connection:
+    """Opened on first use so importing this module never touches disk."""
+    global _connection
+    if _connection is None:
+        connection = sqlite3.connect(DB_NAME, isolation_level=None, factory=TimedConnection)
+        connection.row_factory = sqlite3.Row
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        migrate_schema(connection)
+        connection.executescript(SCHEMA)
+        _connection = connection
+    return _connection
+
+
+def migrate_schema(connection: sqlite3.Connection) -> None:
+    """Bring a db file written by an older version up to date, a new file starts at the latest version."""
+    version = connection.execute('PRAGMA user_version').fetchone()[0]
+    if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table'").fetchone():
+        for script in MIGRATIONS[version:]:
+            if callable(script):
+                script(connection)
+            else:
+                connection.executescript(script)
+            # bumped after each step, so a failed one is retried from where it stopped
+            version += 1
+            connection.execute(f'PRAGMA user_version = {version}')
+    connection.execute(f'PRAGMA user_version = {len(MIGRATIONS)}')
 
 
-def table_exists(table_name: str) -> bool:
-    return len(db.table(table_name).all()) > 0
+def cache_put(cache: LRUCache, key: Hashable, value: Any) -> None:
+    if _pending_puts is None:
+        cache.put(key, value)
+    else:
+        cache.pop(key)
+        _pending_puts.append((cache, key, value))
+
+
+@contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    """BEGIN ... COMMIT, or ROLLBACK on any error. Cache updates are held back until the COMMIT,
+    so a rolled back write never stays cached."""
+    global _pending_puts
+    connection = get_connection()
+    connection.execute('BEGIN')
+    _pending_puts = []
+    try:
+        yield connection
+        connection.execute('COMMIT')
+    except BaseException:
+        connection.execute('ROLLBACK')
+        # reads inside the transaction may have cached rows that no longer exist
+        for cache, key, _ in _pending_puts:
+            cache.pop(key)
+        raise
+    else:
+        for cache, key, value in _pending_puts:
+            cache.put(key, value)
+    finally:
+        _pending_puts = None
 
 
 def init_db() -> None:
-    if not table_exists('auth'):
-        db.table('auth').insert({'token': None, 'expiry': 0})
-    if not table_exists('settings'):
-        db.table('settings').insert({'name': 'watch_list', 'value': []})
-    if not table_exists('prices'):
-        db.table('prices').insert({'code': None, 'price': 0, 'type': 'current', 'expiry': 0, 'length': None})
+    migrate_json_db()
+
+
+def migrate_json_db(path: str = LEGACY_DB_NAME) -> None:
+    """One-shot import of a TinyDB db.json, renamed afterwards so it only runs once."""
+    if not os.path.exists(path):
+        return
+    with open(path, encoding='utf-8') as file:
+        content = file.read().strip()
+    legacy = json.loads(content) if content else {}
+
+    with transaction():
+        for record in legacy.get('auth', {}).values():
+            if record.get('token'):
+                update_auth_token_record({'token': record['token'], 'expiry': record.get('expiry') or 0}, DEFAULT_USER)
+        for record in legacy.get('settings', {}).values():
+            if record.get('name') and record.get('value') is not None:
+                name = record['name']
+                if name in ACCOUNT_SETTINGS:
+                    name = user_setting_name(name, DEFAULT_USER)
+                set_setting(name, record['value'], record.get('expiry'))
+        for record in legacy.get('prices', {}).values():
+            if record.get('code') and record.get('price') is not None:
+                price_info: PriceReturn = {'price': record['price'], 'expiry': record.get('expiry')}
+                insert_price_record(record['code'], record.get('length'), price_info, record['type'])
+    os.replace(path, f'{path}.migrated')
 
 
 def insert_price_record(code: str, length: Optional[PriceLength], price_info: PriceReturn, price_type: PriceType) -> PriceRecord:
@@ -28,45 +214,262 @@ def insert_price_record(code: str, length: Optional[PriceLength], price_info: Pr
         'type': price_type,
         'expiry': price_info['expiry'],
     }
-    query = {'code': code, 'type': price_type}
-
     if length:
         price_record['length'] = length
-        query['length'] = length
 
-    query = Query().fragment(query)
-    db.table('prices').update(price_record, query)
+    get_connection().execute(
+        """INSERT INTO prices (code, type, length, price, expiry) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (code, type, length) DO UPDATE SET price = excluded.price, expiry = excluded.expiry""",
+        (code, price_type, length or '', price_record['price'], price_record['expiry'])
+    )
+    cache_put(price_cache, (code, price_type, length or ''), dict(price_record))
 
     return price_record
 
-def get_price_record(code: str, price_type: PriceType, length: Optional[PriceLength]) -> PriceRecord | None:
-    query = {'code': code, 'type': price_type}
-    if length:
-        query['length'] = length
-    query = Query().fragment(query)
-    record = db.table('prices').search(query)
-    if not record:
-        return None
-    if record_expired(record[0]):
-        return None
-    return record[0]
 
+def get_price_record(code: str, price_type: PriceType, length: Optional[PriceLength],
+                     allow_stale: bool = False) -> PriceRecord | None:
+    """None once the record expired, unless `allow_stale`: then a copy marked 'stale' is returned."""
+    key = (code, price_type, length or '')
+    record = price_cache.get(key)
+    if record is MISSING:
+        row = get_connection().execute(
+            "SELECT code, type, length, price, expiry FROM prices WHERE code = ? AND type = ? AND length = ?", key
+        ).fetchone()
+        record = row_to_price_record(row) if row else None
+        price_cache.put(key, record)
+    if record and record_expired(record):
+        return {**record, 'stale': True} if allow_stale else None
+    # copies, so a caller changing what it got cannot change the cache
+    return dict(record) if record else None
 
-def record_expired(record: dict | None) -> bool:
+
+def row_to_price_record(row: sqlite3.Row) -> PriceRecord:
+    record: PriceRecord = {'code': row['code'], 'price': row['price'], 'type': row['type'], 'expiry': row['expiry']}
+    if row['length']:
+        record['length'] = row['length']
+    return record
+
+
+def record_expired(record: dict | None, ahead: int = 0) -> bool:
     if not record:
         return True
     expiry = record.get('expiry')
     if not expiry:
         return False
-    return expiry < now()
+    return expiry < now() + ahead
+
+
+def get_setting(name: str, allow_stale: bool = False) -> Any:
+    """None once the setting expired, unless `allow_stale`."""
+    setting = settings_cache.get(name)
+    if setting is MISSING:
+        row = get_connection().execute("SELECT value, expiry FROM settings WHERE name = ?", (name,)).fetchone()
+        setting = {'value': json.loads(row['value']), 'expiry': row['expiry']} if row else None
+        settings_cache.put(name, setting)
+    if not setting or (record_expired(setting) and not allow_stale):
+        return None
+    return copy.deepcopy(setting['value'])
+
+
+def set_setting(name: str, value: Any, expiry: int | None = None) -> None:
+    get_connection().execute(
+        """INSERT INTO settings (name, value, expiry) VALUES (?, ?, ?)
+        ON CONFLICT (name) DO UPDATE SET value = excluded.value, expiry = excluded.expiry""",
+        (name, json.dumps(value), expiry)
+    )
+    cache_put(settings_cache, name, {'value': copy.deepcopy(value), 'expiry': expiry})
+
+
+def user_setting_name(name: str, user: int) -> str:
+    return f'{name}:{user}'
+
+
+def get_user_setting(name: str, user: int, allow_stale: bool = False) -> Any:
+    return get_setting(user_setting_name(name, user), allow_stale)
+
+
+def set_user_setting(name: str, value: Any, user: int, expiry: int | None = None) -> None:
+    set_setting(user_setting_name(name, user), value, expiry)
+
+
+def get_history_record(code: str) -> HistoryRecord | None:
+    record = history_cache.get(code)
+    if record is MISSING:
+        row = get_connection().execute("SELECT code, span, refreshed, expiry FROM history WHERE code = ?", (code,)).fetchone()
+        record = dict(row) if row else None
+        history_cache.put(code, record)
+    return dict(record) if record else None
+
+
+def upsert_history_record(record: HistoryRecord) -> None:
+    get_connection().execute(
+        """INSERT INTO history (code, span, refreshed, expiry) VALUES (:code, :span, :refreshed, :expiry)
+        ON CONFLICT (code) DO UPDATE SET span = excluded.span, refreshed = excluded.refreshed, expiry = excluded.expiry""",
+        record
+    )
+    cache_put(history_cache, record['code'], dict(record))
+
+
+def list_alert_rules() -> list[AlertRule]:
+    rows = get_connection().execute(
+        "SELECT id, code, kind, length, threshold, guild_id, user_id FROM alert_rules ORDER BY id"
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def insert_alert_rule(rule: AlertRule) -> AlertRule:
+    cursor = get_connection().execute(
+        """INSERT INTO alert_rules (code, kind, length, threshold, guild_id, user_id)
+        VALUES (:code, :kind, :length, :threshold, :guild_id, :user_id)""", rule
+    )
+    return {**rule, 'id': cursor.lastrowid}
+
+
+def delete_alert_rule(rule_id: int) -> bool:
+    return get_connection().execute("DELETE FROM alert_rules WHERE id = ?", (rule_id,)).rowcount > 0
+
+
+def get_guild_channel(guild: int) -> int | None:
+    row = get_connection().execute("SELECT channel_id FROM guilds WHERE id = ?", (guild,)).fetchone()
+    return row['channel_id'] if row else None
+
+
+def set_guild_channel(guild: int, channel: int) -> None:
+    get_connection().execute(
+        "INSERT INTO guilds (id, channel_id) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET channel_id = excluded.channel_id",
+        (guild, channel)
+    )
+
+
+def get_http_cache_entry(url: str) -> dict | None:
+    row = get_connection().execute(
+        "SELECT url, body, etag, last_modified, expiry FROM http_cache WHERE url = ?", (url,)
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def upsert_http_cache_entry(url: str, body: bytes, etag: str | None, last_modified: str | None, expiry: int) -> None:
+    """Also drops the entries expired more than HTTP_CACHE_RETENTION seconds ago, which would otherwise
+    pile up for every symbol ever charted."""
+    connection = get_connection()
+    connection.execute("DELETE FROM http_cache WHERE expiry < ?", (now() - HTTP_CACHE_RETENTION,))
+    connection.execute(
+        """INSERT INTO http_cache (url, body, etag, last_modified, expiry) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (url) DO UPDATE SET body = excluded.body, etag = excluded.etag,
+        last_modified = excluded.last_modified, expiry = excluded.expiry""",
+        (url, body, etag, last_modified, expiry)
+    )
+
+
+def update_http_cache_expiry(url: str, expiry: int) -> None:
+    get_connection().execute("UPDATE http_cache SET expiry = ? WHERE url = ?", (expiry, url))
+
+
+def get_auth_token_record(user: int) -> AuthToken:
+    row = get_connection().execute("SELECT token, expiry FROM auth WHERE user_id = ?", (user,)).fetchone()
+    return {'token': row['token'], 'expiry': row['expiry']} if row else {'token': None, 'expiry': 0}
+
+
+def update_auth_token_record(auth_token: AuthToken, user: int) -> None:
+    get_connection().execute(
+        """INSERT INTO auth (user_id, token, expiry) VALUES (?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET token = excluded.token, expiry = excluded.expiry""",
+        (user, auth_token['token'], auth_token['expiry'])
+    )
+
+
+def get_stock_account_id_record(user: int) -> int | None:
+    return get_user_setting('account_id', user)
+
+
+def insert_stock_account_id_record(account_id: int, user: int) -> None:
+    set_user_setting('account_id', account_id, user)
+
+
+def default_user() -> User | None:
+    """The account configured in .env, never stored in the users table."""
+    if not VP_USERNAME or not VP_PASSWORD:
+        return None
+    return {'id': DEFAULT_USER, 'username': VP_USERNAME, 'password': VP_PASSWORD}
+
+
+@lru_cache(maxsize=1)
+def credentials_cipher() -> 'Fernet':
+    # imported on first use, only registered users' passwords need it and cli.py price never does
+    from cryptography.fernet import Fernet
+    if not CREDENTIALS_KEY:
+        raise ValueError("CREDENTIALS_KEY is not set in .env, registered passwords cannot be stored")
+    return Fernet(CREDENTIALS_KEY)
+
+
+def encrypt_password(password: str) -> str:
+    return credentials_cipher().encrypt(password.encode()).decode()
+
+
+def decrypt_password(token: str) -> str:
+    from cryptography.fernet import InvalidToken
+    try:
+        return credentials_cipher().decrypt(token.encode()).decode()
+    except InvalidToken:
+        raise ValueError("Stored password cannot be decrypted, was CREDENTIALS_KEY changed?") from None
+
+
+def encrypt_stored_passwords(connection: sqlite3.Connection) -> None:
+    if not connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchone():
+        return
+    rows = connection.execute("SELECT id, password FROM users").fetchall()
+    connection.execute('BEGIN')
+    try:
+        for row in rows:
+            connection.execute("UPDATE users SET password = ? WHERE id = ?", (encrypt_password(row['password']), row['id']))
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+
+
+def get_user(user: int) -> User | None:
+    """Credentials of a user with the password decrypted, ValueError when it cannot be."""
+    if user == DEFAULT_USER:
+        return default_user()
+    row = get_connection().execute("SELECT id, username, password FROM users WHERE id = ?", (user,)).fetchone()
+    return {'id': row['id'], 'username': row['username'], 'password': decrypt_password(row['password'])} if row else None
+
+
+def user_registered(user: int) -> bool:
+    return bool(get_connection().execute("SELECT 1 FROM users WHERE id = ?", (user,)).fetchone())
+
+
+def list_user_ids() -> list[int]:
+    """The .env account (when configured) first, then every registered user."""
+    rows = get_connection().execute("SELECT id FROM users ORDER BY id").fetchall()
+    return [*([DEFAULT_USER] if default_user() else []), *(row['id'] for row in rows)]
+
+
+def upsert_user(user: User) -> None:
+    """The password is stored encrypted with CREDENTIALS_KEY. New credentials may point at another account,
+    so the old token and account settings are dropped."""
+    password = encrypt_password(user['password'])
+    with transaction() as connection:
+        connection.execute(
+            """INSERT INTO users (id, username, password) VALUES (?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET username = excluded.username, password = excluded.password""",
+            (user['id'], user['username'], password)
+        )
+        forget_user_account(user['id'])
 
 
-def get_stock_account_id_record() -> int | None:
-    account_id = db.table('settings').search(Query().name == 'account_id')
-    if account_id:
-        account_id = account_id[0]['value']
-    return account_id
+def delete_user(user: int) -> bool:
+    with transaction() as connection:
+        deleted = connection.execute("DELETE FROM users WHERE id = ?", (user,)).rowcount > 0
+        forget_user_account(user)
+    return deleted
 
 
-def insert_stock_account_id_record(account_id: int) -> None:
-    db.table('settings').update({'name': 'account_id', 'value': account_id}, Query().name == 'account_id')
+def forget_user_account(user: int) -> None:
+    connection = get_connection()
+    connection.execute("DELETE FROM auth WHERE user_id = ?", (user,))
+    for name in ACCOUNT_SETTINGS:
+        connection.execute("DELETE FROM settings WHERE name = ?", (user_setting_name(name, user),))
+        cache_put(settings_cache, user_setting_name(name, user), None)
@@ -0,0 +1,184 @@
+from typing import Any, Callable
+
+# appended to cells computed from expired prices, the table is edited once they are refreshed
+STALE_MARK = '~'
+MISSING_CELL = '-'
+
+SUMMARY_OPTION = {
+    'prefix': False,
+    'threshold': 15,
+    'up_color': 'green',
+    'down_color': 'red',
+    'with_root': True
+}
+OWN_LIST_OPTION = {
+    'prefix': False,
+    'up_color': 'green',
+    'down_color': 'red',
+    'with_root': True
+}
+
+
+def direction_percent(root: float, sub: float, option=None) -> str:
+    option = {
+        'prefix': True,
+        'threshold': None,
+        'up_color': 'green',
+        'down_color': 'red',
+        'with_root': False,
+        'from_a_to_b': False,
+        **(option or {})
+    }
+    if option['from_a_to_b']:
+        percent_last = (sub - root) / root * 100
+    else:
+        percent_last = (root - sub) / sub * 100
+    prefix = ''
+    if option['prefix']:
+        prefix = '+' if percent_last >= 0 else ''
+
+    if option['threshold']:
+        if percent_last > option['threshold']:
+            percent_last_color = option['up_color']
+        elif percent_last < 0:
+            percent_last_color = option['down_color']
+        else:
+            percent_last_color = 'normal'
+    else:
+        percent_last_color = option['up_color'] if percent_last >= 0 else option['down_color']
+
+    if abs(percent_last) > 12:
+        percent_text = int(percent_last)
+    elif abs(percent_last) > 1:
+        percent_text = f'{percent_last:.1f}'
+    else:
+        percent_text = f'{percent_last:.2f}'
+    full_percent_text = format_color(f'{prefix}{percent_text}%', percent_last_color) if abs(percent_last) > 0 else ''
+    root_text = ''
+    if option['with_root']:
+        root_text = f'{root:.2f} '
+    return f'{root_text}{full_percent_text}'
+
+
+def format_color(string: str, color: str) -> str:
+    color_code = {'red': '31', 'green': '32', 'yellow': '33', 'blue': '34', 'purple': '35', 'cyan': '36',
+                  'white': '37'}.get(color)
+    return f'\x1b[2;{color_code}m{string}\x1b[0m' if color_code else string
+
+
+#font: SUB-ZERO
+#size: 6pt
+#https://www.asciiart.eu/text-to-ascii-art
+def summary_title() -> str:
+    return r"""
+ ______     __  __     __    __     __    __     ______     ______     __  __   
+/\  ___\   /\ \/\ \   /\ "-./  \   /\ "-./  \   /\  __ \   /\  == \   /\ \_\ \  
+\ \___  \  \ \ \_\ \  \ \ \-./\ \  \ \ \-./\ \  \ \  __ \  \ \  __<   \ \____ \ 
+ \/\_____\  \ \_____\  \ \_\ \ \_\  \ \_\ \ \_\  \ \_\ \_\  \ \_\ \_\  \/\_____\
+  \/_____/   \/_____/   \/_/  \/_/   \/_/  \/_/   \/_/\/_/   \/_/ /_/   \/_____/
+    """
+
+
+def own_list_title() -> str:
+    return r"""
+ ______     __     __     __   __        __         __     ______     ______ 
+/\  __ \   /\ \  _ \ \   /\ "-.\ \      /\ \       /\ \   /\  ___\   /\__  _\
+\ \ \/\ \  \ \ \/ ".\ \  \ \ \-.  \     \ \ \____  \ \ \  \ \___  \  \/_/\ \/
+ \ \_____\  \ \__/".~\_\  \ \_\\"\_\     \ \_____\  \ \_\  \/\_____\    \ \_\
+  \/_____/   \/_/   \/_/   \/_/ \/_/      \/_____/   \/_/   \/_____/     \/_/
+"""
+
+
+def portfolio_title() -> str:
+    return "\nPORTFOLIO (million VND)\n"
+
+
+def cell(row: dict[str, Any], keys: tuple[str, ...], render: Callable[[], Any]) -> str:
+    """One table cell from the row values in `keys`: '-' while any is unknown, STALE_MARK appended
+    when any of them is an expired value (services.price_snapshot lists those under 'stale')."""
+    if any(row.get(key) is None for key in keys):
+        return MISSING_CELL
+    stale = row.get('stale', ())
+    return f"{render()}{STALE_MARK if any(key in stale for key in keys) else ''}"
+
+
+def summary_table(rows: list[dict[str, Any]]) -> list[dict[str, str]]:
+    table = []
+    for row in rows:
+        def max_cell(key: str) -> str:
+            return cell(row, (key, 'last'), lambda: direction_percent(row[key], row['last'], SUMMARY_OPTION))
+
+        table.append({
+            'Code': row['code'],
+            'Last': cell(row, ('last', 'root'), lambda: f"{row['last']:.2f} {direction_percent(row['last'], row['root'])}"),
+            'Min 3M': cell(row, ('min_3m',), lambda: row['min_3m']),
+            'Max 3M': max_cell('max_3m'),
+            'Min 1Y': cell(row, ('min_1y',), lambda: row['min_1y']),
+            'Max 1Y': max_cell('max_1y'),
+            'Max 3Y': max_cell('max_3y'),
+            'Min 3Y': cell(row, ('min_3y',), lambda: row['min_3y']),
+        })
+    return table
+
+
+def own_list_table(rows: list[dict[str, Any]]) -> list[dict[str, str]]:
+    table = []
+    for row in rows:
+        def max_cell(key: str) -> str:
+            return cell(row, (key,), lambda: direction_percent(row[key], row['buy_price'], OWN_LIST_OPTION))
+
+        table.append({
+            'Code': row['code'],
+            'Available': f"{row['available']}/{row['total']}",
+            'Buy at': cell(row, ('last',), lambda: direction_percent(row['buy_price'], row['last'],
+                                                                     {'with_root': True, 'from_a_to_b': True})),
+            'Direction': cell(row, ('last', 'root'), lambda: direction_percent(row['last'], row['root'])),
+            'Max 3M': max_cell('max_3m'),
+            'Max 1Y': max_cell('max_1y'),
+            'Max 3Y': max_cell('max_3y'),
+        })
+    return table
+
+
+def portfolio_table(portfolio) -> list[dict[str, str]]:
+    """Holdings of a portfolio.Portfolio by weight plus a totals row, value columns in million VND."""
+    option = {'prefix': True, 'from_a_to_b': True}
+    table = []
+    for i in (-portfolio.weight).argsort(kind='stable'):
+        table.append({
+            'Code': portfolio.codes[i],
+            'Value': f'{portfolio.value[i] / 1000:.1f}',
+            'Weight': f'{portfolio.weight[i]:.1f}%',
+            'P&L': f'{portfolio.pnl[i] / 1000:+.1f}',
+            'P&L %': direction_percent(portfolio.buy_price[i], portfolio.last[i], option),
+            'DD 1Y': direction_percent(portfolio.max_1y[i], portfolio.last[i], option),
+            'DD 3Y': direction_percent(portfolio.max_3y[i], portfolio.last[i], option),
+        })
+    totals = portfolio.totals()
+    table.append({
+        'Code': 'Total',
+        'Value': f"{totals['value'] / 1000:.1f}",
+        'Weight': '100%',
+        'P&L': f"{totals['pnl'] / 1000:+.1f}",
+        'P&L %': format_color(f"{totals['pnl_percent']:+.2f}%", 'green' if totals['pnl'] >= 0 else 'red'),
+        'DD 1Y': f"{totals['drawdown_1y']:.1f}%",
+        'DD 3Y': f"{totals['drawdown_3y']:.1f}%",
+    })
+    return table
+
+
+def scan_title() -> str:
+    return "\nSCAN: closest to a low first, * marks a root reversal\n"
+
+
+def scan_table(results: list[dict[str, Any]], lengths: tuple[str, ...] = ('3M', '1Y', '3Y')) -> list[dict[str, str]]:
+    """Scanner.Scan results, each low column shows the low and how far the last close is above it."""
+    table = []
+    for result in results:
+        row = {'Code': result['code'], 'Last': f"{result['last']:.2f}"}
+        for length in lengths:
+            key = length.lower()
+            row[f'Min {length}'] = f"{result[f'min_{key}']:.2f} +{result[f'above_min_{key}']:.1f}%"
+        row['Root'] = f"{result['root']:.2f}{' *' if result['reversal'] else ''}"
+        table.append(row)
+    return table
@@ -0,0 +1,192 @@
+import os
+import sys
+from typing import Literal
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from chart import ChartColumns, CHART_KEYS, decode_price_history
+from constant import CHART_TYPE, HISTORY_DIR
+from db import get_history_record, upsert_history_record
+from utils import expiry_plus, now
+
+Extreme = tuple[int, float]
+# one fixed-size little-endian row per trading day, the layout of the on-disk history files
+HISTORY_DTYPE = np.dtype([
+    ('timestamp', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'), ('close', '<f8'), ('volume', '<f8'),
+])
+
+
+class PriceSeries:
+    """Daily OHLCV rows of one symbol sorted by date, parsed once from a getPriceChartLine response
+    or mapped straight from a history file."""
+
+    def __init__(self, records: np.ndarray):
+        self.records = records
+
+    @classmethod
+    def from_body(cls, body: bytes) -> 'PriceSeries':
+        """Straight from a getPriceChartLine response body, see chart.decode_price_history."""
+        return cls.from_columns(decode_price_history(body))
+
+    @classmethod
+    def from_columns(cls, columns: ChartColumns) -> 'PriceSeries':
+        if not len(columns):
+            raise ValueError("Invalid response: PriceHistory is empty")
+        records = np.empty(len(columns), dtype=HISTORY_DTYPE)
+        records['timestamp'] = np.frombuffer(columns.timestamps, dtype=np.int64)
+        for field in CHART_KEYS:
+            records[field] = np.frombuffer(getattr(columns, field), dtype=np.float64)
+        # responses are usually in date order already, which makes the sort unnecessary
+        if np.any(records['timestamp'][1:] < records['timestamp'][:-1]):
+            records = records[np.argsort(records['timestamp'], kind='stable')]
+        return cls(records)
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self.records['timestamp']
+
+    @property
+    def closes(self) -> np.ndarray:
+        return self.records['close']
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def last(self) -> float:
+        return float(self.closes[-1])
+
+    def window(self, length: Literal['1W', '1M', '3M', '1Y', '3Y'], until: int | None = None) -> 'PriceSeries':
+        """The rows that a `length` chart downloaded at `until` (default now) would contain."""
+        start = (until if until is not None else now()) - expiry_plus(length)
+        index = np.searchsorted(self.timestamps, start, side='left')
+        return PriceSeries(self.records[index:])
+
+    def merge(self, newer: 'PriceSeries') -> 'PriceSeries':
+        """Union of both series by trading date, rows from `newer` win for dates present in both."""
+        records = np.concatenate((self.records[~np.isin(self.timestamps, newer.timestamps)], newer.records))
+        return PriceSeries(records[np.argsort(records['timestamp'], kind='stable')])
+
+    def extremes(self) -> tuple[Extreme, Extreme]:
+        """(timestamp, price) of the minimum and maximum close, the most recent one on ties."""
+        if not len(self):
+            raise ValueError("Invalid response: PriceHistory is empty")
+        last_index = len(self) - 1
+        min_index = last_index - int(np.argmin(self.closes[::-1]))
+        max_index = last_index - int(np.argmax(self.closes[::-1]))
+        return ((int(self.timestamps[min_index]), float(self.closes[min_index])),
+                (int(self.timestamps[max_index]), float(self.closes[max_index])))
+
+    def rolling_argmin(self, rows: int) -> np.ndarray:
+        """Index of the lowest close in the `rows` trading days ending at each day (from day `rows - 1` on)."""
+        return sliding_window_view(self.closes, rows).argmin(axis=1) + np.arange(len(self) - rows + 1)
+
+    def rolling_argmax(self, rows: int) -> np.ndarray:
+        return sliding_window_view(self.closes, rows).argmax(axis=1) + np.arange(len(self) - rows + 1)
+
+    def rolling_min(self, rows: int) -> np.ndarray:
+        return sliding_window_view(self.closes, rows).min(axis=1)
+
+    def rolling_max(self, rows: int) -> np.ndarray:
+        return sliding_window_view(self.closes, rows).max(axis=1)
+
+    def root_and_sub_root(self) -> tuple[float, float]:
+        """Vectorized form of folding services.determine_root_and_sub_price over the closes:
+        sub root is the last close and root is the close where the direction last reversed."""
+        if len(self) < 2:
+            raise ValueError("Invalid response: PriceHistory is too short")
+        closes = self.closes
+        values = closes[np.concatenate(([True], closes[1:] != closes[:-1]))]
+        if len(values) < 3:
+            return float(values[0]), float(values[-1])
+
+        falling = values[:-1] > values[1:]
+        reversals = np.flatnonzero(falling[:-1] != falling[1:])
+        root = values[reversals[-1] + 1] if len(reversals) else values[0]
+        return float(root), float(values[-1])
+
+
+class HistoryStore:
+    """Longest series seen per symbol, kept current by merging short tail charts into it.
+
+    Each symbol has an append-only file of HISTORY_DTYPE rows under `directory`, read through a
+    memory map. Only trading days after the last stored one are appended; the last stored row is
+    patched in place when a download revises it (the still-open session's close). The span and
+    refresh times live in the db `history` table."""
+
+    def __init__(self, directory: str = HISTORY_DIR):
+        self.directory = directory
+        self.series: dict[str, PriceSeries] = {}
+
+    def path(self, code: str) -> str:
+        return os.path.join(self.directory, f'{code}.bin')
+
+    def covers(self, code: str, chart_type: str) -> bool:
+        record = get_history_record(code)
+        return bool(record) and list(CHART_TYPE).index(record['span']) >= list(CHART_TYPE).index(chart_type) \
+            and self.get(code) is not None
+
+    def fresh(self, code: str) -> bool:
+        """Refreshed since the last close or open (the 'end_day' expiry), so no daily close can be missing."""
+        record = get_history_record(code)
+        return bool(record) and record['expiry'] > now()
+
+    def mergeable(self, code: str, tail_type: str) -> bool:
+        """A `tail_type` chart still overlaps the stored series, so merging it leaves no gap."""
+        record = get_history_record(code)
+        return bool(record) and now() - record['refreshed'] < expiry_plus(tail_type)
+
+    def get(self, code: str) -> PriceSeries | None:
+        if code not in self.series:
+            path = self.path(code)
+            if not os.path.exists(path) or not self.repair(code):
+                return None
+            self.series[code] = PriceSeries(np.memmap(path, dtype=HISTORY_DTYPE, mode='r'))
+        return self.series[code]
+
+    def repair(self, code: str) -> int:
+        """Rows left in the file after cutting off a partly written row (a write interrupted by a full disk
+        or a kill). The record is expired so the next request merges the lost days back in."""
+        path = self.path(code)
+        size = os.path.getsize(path)
+        rows, torn = divmod(size, HISTORY_DTYPE.itemsize)
+        if torn:
+            print(f'History of {code} ends in a partial row, truncating it to {rows} rows', file=sys.stderr)
+            os.truncate(path, rows * HISTORY_DTYPE.itemsize)
+            record = get_history_record(code)
+            if record:
+                upsert_history_record({**record, 'expiry': 0})
+        return rows
+
+    def put(self, code: str, series: PriceSeries, span: str) -> PriceSeries:
+        self.write(code, series)
+        upsert_history_record({'code': code, 'span': span, 'refreshed': now(), 'expiry': now() + expiry_plus('end_day')})
+        return self.get(code)
+
+    def merge(self, code: str, tail: PriceSeries) -> PriceSeries:
+        return self.put(code, tail, get_history_record(code)['span'])
+
+    def write(self, code: str, series: PriceSeries) -> None:
+        stored = self.get(code)
+        self.series.pop(code, None)
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(code)
+
+        if stored is None or series.timestamps[0] < stored.timestamps[0]:
+            # rows older than the start of the file can only be added by rewriting it
+            merged = stored.merge(series) if stored is not None else series
+            temporary = f'{path}.tmp'
+            merged.records.tofile(temporary)
+            os.replace(temporary, path)
+            return
+
+        last_timestamp = stored.timestamps[-1]
+        revised = series.records[series.timestamps == last_timestamp]
+        newer = series.records[series.timestamps > last_timestamp]
+        with open(path, 'r+b') as file:
+            if len(revised) and revised[-1].tobytes() != stored.records[-1].tobytes():
+                file.seek((len(stored) - 1) * HISTORY_DTYPE.itemsize)
+                file.write(revised[-1].tobytes())
+            file.seek(0, os.SEEK_END)
+            file.write(newer.tobytes())
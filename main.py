@@ -1,174 +1,139 @@
-import re
+import asyncio
+import time
+import traceback
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from typing import Awaitable, Callable
 
 import discord
 from discord.ext import commands, tasks
 
-from constant import DISCORD_BOT_TOKEN, DISCORD_TEST_CHANNEL_ID
-from services import get_root_price, get_last_price, get_min_max_price, get_watch_list, get_own_list
-from db import init_db
+from api import close_session, NETWORK_ERRORS
+from alerts import alert_engine, format_rule
+from auth import get_token_manager, forget_token_manager
+from constant import DISCORD_BOT_TOKEN, DISCORD_TEST_CHANNEL_ID, REFRESH_INTERVAL, REALTIME_INTERVAL, \
+    DISCORD_MESSAGE_LIMIT, DEFAULT_USER, METRICS_FILE, METRICS_INTERVAL, SCAN_TOP, SCAN_UPDATE_INTERVAL, PAGE_SIZE, \
+    check_symbol
+from services import get_watch_list, get_own_list, price_snapshot, budget_left, refresh_within_budget, revalidate
+from formatting import summary_table, own_list_table, portfolio_table, summary_title, own_list_title, portfolio_title, \
+    scan_table, scan_title
+from db import init_db, get_user_setting, user_registered, upsert_user, delete_user, get_guild_channel, set_guild_channel
+from render import send_table
+from realtime import feed
+from scheduler import refresh_prices, tracked_codes
+from market import market_open
+from metrics import metrics
+from portfolio import load_portfolio
+from scanner import Scan, load_universe
+from plot import chart_file, shutdown_pool
+from pages import SummaryPages
 
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
-
-
-def direction_percent(root: float, sub: float, option=None) -> str:
-    option = {
-        'prefix': True,
-        'threshold': None,
-        'up_color': 'green',
-        'down_color': 'red',
-        'with_root': False,
-        'from_a_to_b': False,
-        **(option or {})
-    }
-    if option['from_a_to_b']:
-        percent_last = (sub - root) / root * 100
-    else:
-        percent_last = (root - sub) / sub * 100
-    prefix = ''
-    if option['prefix']:
-        prefix = '+' if percent_last >= 0 else ''
-
-    if option['threshold']:
-        if percent_last > option['threshold']:
-            percent_last_color = option['up_color']
-        elif percent_last < 0:
-            percent_last_color = option['down_color']
-        else:
-            percent_last_color = 'normal'
-    else:
-        percent_last_color = option['up_color'] if percent_last >= 0 else option['down_color']
 
-    if abs(percent_last) > 12:
-        percent_text = int(percent_last)
-    elif abs(percent_last) > 1:
-        percent_text = f'{percent_last:.1f}'
-    else:
-        percent_text = f'{percent_last:.2f}'
-    full_percent_text = format_color(f'{prefix}{percent_text}%', percent_last_color) if abs(percent_last) > 0 else ''
-    root_text = ''
-    if option['with_root']:
-        root_text = f'{root:.2f} '
-    return f'{root_text}{full_percent_text}'
-
-
-async def print_table_to_discord(table: list[dict[str, str]], title, channel=None) -> None:
-    column_widths = {}
-    label = table[0].keys()
-    for key in label:
-        max_column_width = len(key)
-        for item in table:
-            column_width = visible_length(str(item[key]))
-            max_column_width = max(max_column_width, column_width)
-        column_widths[key] = max_column_width
-
-    header = " | ".join(key.ljust(column_widths[key]) for key in label)
-    data_text = "```ansi\n" + title + "\n" + header + "\n"
-    for item in table:
-        row = " | ".join(custom_ljust(str(item[key]), column_widths[key]) for key in label)
-        data_text += row + "\n"
-
-    data_text += "```"
+class StockBot(commands.Bot):
+    async def close(self) -> None:
+        await close_session()
+        shutdown_pool()
+        await super().close()
+
+
+bot = StockBot(command_prefix='!', intents=intents)
+# revalidations still running after their command answered, referenced so they are not garbage collected
+background_tasks: set[asyncio.Task] = set()
+feed.subscribe(alert_engine.on_ticks)
+
+
+@metrics.timed('discord.print_table')
+async def print_table_to_discord(table: list[dict[str, str]], title, channel=None, edit=False) -> None:
     if not channel:
         channel = bot.get_channel(int(DISCORD_TEST_CHANNEL_ID))
-    await channel.send(data_text)
-
-
-async def show_summary(channel=None) -> None:
-    table = []
-    option = {
-        'prefix': False,
-        'threshold': 15,
-        'up_color': 'green',
-        'down_color': 'red',
-        'with_root': True
-    }
-    for code in get_watch_list():
-        root_price = get_root_price(code)
-        last_price = get_last_price(code)
-        min_price_3m, max_price_3m = get_min_max_price(code, '3M')
-        min_price_1y, max_price_1y = get_min_max_price(code, '1Y')
-        min_price_3y, max_price_3y = get_min_max_price(code, '3Y')
-        table.append({
-            'Code': code,
-            'Last': f'{last_price:.2f} {direction_percent(last_price, root_price)}',
-            'Min 3M': min_price_3m,
-            'Max 3M': direction_percent(max_price_3m, last_price, option),
-            'Min 1Y': min_price_1y,
-            'Max 1Y': direction_percent(max_price_1y, last_price, option),
-            'Max 3Y': direction_percent(max_price_3y, last_price, option),
-            'Min 3Y': min_price_3y,
-        })
-    await print_table_to_discord(table, summary_title(), channel)
-
-
-async def show_own_list(channel=None) -> None:
-    table = []
-    option = {
-        'prefix': False,
-        'up_color': 'green',
-        'down_color': 'red',
-        'with_root': True
-    }
-    for stock in get_own_list():
-        code = stock['code']
-        buy_at = stock['buy_price']
-        root_price = get_root_price(code)
-        last_price = get_last_price(code)
-        _, max_price_3m = get_min_max_price(code, '3M')
-        _, max_price_1y = get_min_max_price(code, '1Y')
-        _, max_price_3y = get_min_max_price(code, '3Y')
-
-        table.append({
-            'Code': code,
-            'Available': f"{stock['available']}/{stock['total']}",
-            'Buy at': f"{direction_percent(buy_at, last_price, {'with_root': True, 'from_a_to_b': True})}",
-            'Direction': direction_percent(last_price, root_price),
-            'Max 3M': direction_percent(max_price_3m, buy_at, option),
-            'Max 1Y': direction_percent(max_price_1y, buy_at, option),
-            'Max 3Y': direction_percent(max_price_3y, buy_at, option),
-        })
-    await print_table_to_discord(table, own_list_title(), channel)
+    await send_table(channel, table, title, edit)
+
+
+def keep_running(coroutine) -> None:
+    task = asyncio.ensure_future(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
 
 
-def format_color(string: str, color: str) -> str:
-    color_code = {'red': '31', 'green': '32', 'yellow': '33', 'blue': '34', 'purple': '35', 'cyan': '36',
-                  'white': '37'}.get(color)
-    return f'\x1b[2;{color_code}m{string}\x1b[0m' if color_code else string
+async def load_within_budget(load: Awaitable[list], name: str, user: int, started: float) -> list:
+    """The watch / own list from `load` (get_watch_list / get_own_list), or the expired copy stored as the
+    `name` user setting once the budget runs out first. The fetch then completes in the background."""
+    task = asyncio.ensure_future(load)
+    done, _ = await asyncio.wait({task}, timeout=budget_left(started))
+    stale = None if done else get_user_setting(name, user, allow_stale=True)
+    if stale is None:
+        return await task
+    metrics.count('command.stale_list', list=name)
+    keep_running(finish_load(task, name))
+    return stale
 
 
-def visible_length(s: str) -> int:
-    return len(re.sub(r'\x1B\[[0-;]*[mK]', '', s))
+async def finish_load(task: asyncio.Future, name: str) -> None:
+    try:
+        await task
+    except (*NETWORK_ERRORS, ValueError) as error:
+        print(f'Fetching {name} failed, the stored one stays: {error}')
 
 
-def custom_ljust(s: str, width: int) -> str:
-    needed = width - visible_length(s)
-    return s + ' ' * needed
+async def print_within_budget(build_table: Callable[[], list[dict[str, str]]], title, channel,
+                              codes: list[str], started: float | None = None) -> None:
+    """Refresh the prices of `codes` until COMMAND_BUDGET seconds after `started` (now by default), then
+    post whatever the db holds (expired values marked stale). A refresh still running edits the message
+    once it completes."""
+    refresh = await refresh_within_budget(codes, started or time.monotonic())
+    await print_table_to_discord(build_table(), title, channel)
+    if refresh:
+        keep_running(revalidate(refresh, lambda: print_table_to_discord(build_table(), title, channel, edit=True)))
+
+
+async def show_summary(channel=None, user: int = DEFAULT_USER, watch_list: list[str] | None = None,
+                       started: float | None = None) -> None:
+    """`watch_list` and `started` when the caller already loaded the list within its budget."""
+    started = started or time.monotonic()
+    if watch_list is None:
+        watch_list = await load_within_budget(get_watch_list(user), 'watch_list', user, started)
+    await print_within_budget(lambda: summary_table([price_snapshot(code) for code in watch_list]),
+                              summary_title(), channel, watch_list, started)
+
+
+async def show_own_list(channel=None, user: int = DEFAULT_USER) -> None:
+    started = time.monotonic()
+    own_list = await load_within_budget(get_own_list(user), 'own_list', user, started)
+    await print_within_budget(lambda: own_list_table([{**stock, **price_snapshot(stock['code'])} for stock in own_list]),
+                              own_list_title(), channel, [stock['code'] for stock in own_list], started)
+
+
+async def show_portfolio(channel=None, user: int = DEFAULT_USER) -> None:
+    await print_table_to_discord(portfolio_table(await load_portfolio(user=user)), portfolio_title(), channel)
+
+
+async def show_scan(channel=None, codes: list[str] | None = None) -> None:
+    """Ranked matches are posted as soon as the first ones arrive, then the same messages are edited."""
+    if not channel:
+        channel = bot.get_channel(int(DISCORD_TEST_CHANNEL_ID))
+    scan = Scan(codes or load_universe())
+    status = await channel.send(f'Scanning {len(scan.codes)} symbols...')
+    posted, updated = False, time.monotonic()
+    async for _ in scan.results():
+        if time.monotonic() - updated >= SCAN_UPDATE_INTERVAL:
+            await print_table_to_discord(scan_table(scan.ranking[:SCAN_TOP]), scan_title(), channel, edit=posted)
+            await status.edit(content=f'Scanning: {scan.progress()}')
+            posted, updated = True, time.monotonic()
+    if scan.ranking:
+        await print_table_to_discord(scan_table(scan.ranking[:SCAN_TOP]), scan_title(), channel, edit=posted)
+    await status.edit(content=f'Scan finished: {scan.progress()}')
 
 
-#font: SUB-ZERO
-#size: 6pt
-#https://www.asciiart.eu/text-to-ascii-art
-def summary_title() -> str:
-    return r"""
- ______     __  __     __    __     __    __     ______     ______     __  __   
-/\  ___\   /\ \/\ \   /\ "-./  \   /\ "-./  \   /\  __ \   /\  == \   /\ \_\ \  
-\ \___  \  \ \ \_\ \  \ \ \-./\ \  \ \ \-./\ \  \ \  __ \  \ \  __<   \ \____ \ 
- \/\_____\  \ \_____\  \ \_\ \ \_\  \ \_\ \ \_\  \ \_\ \_\  \ \_\ \_\  \/\_____\
-  \/_____/   \/_____/   \/_/  \/_/   \/_/  \/_/   \/_/\/_/   \/_/ /_/   \/_____/
-    """
+async def show_stats(channel=None) -> None:
+    await print_table_to_discord(metrics.latency_rows() or [{'Span': '-'}], stats_title('latency'), channel)
+    await print_table_to_discord(metrics.counter_rows(), stats_title('counters'), channel)
 
 
-def own_list_title() -> str:
-    return r"""
- ______     __     __     __   __        __         __     ______     ______ 
-/\  __ \   /\ \  _ \ \   /\ "-.\ \      /\ \       /\ \   /\  ___\   /\__  _\
-\ \ \/\ \  \ \ \/ ".\ \  \ \ \-.  \     \ \ \____  \ \ \  \ \___  \  \/_/\ \/
- \ \_____\  \ \__/".~\_\  \ \_\\"\_\     \ \_____\  \ \_\  \/\_____\    \ \_\
-  \/_____/   \/_/   \/_/   \/_/ \/_/      \/_____/   \/_/   \/_____/     \/_/
-"""
+def stats_title(kind: str) -> str:
+    return f"\nSTATS: {kind} since {datetime.fromtimestamp(int(metrics.started))}\n"
 
 
 async def check_owner(ctx) -> bool:
@@ -178,10 +143,65 @@ async def check_owner(ctx) -> bool:
     return True
 
 
+def command_user(ctx) -> int:
+    """The caller's own VPBanks account once they registered one, the .env account otherwise."""
+    return ctx.author.id if user_registered(ctx.author.id) else DEFAULT_USER
+
+
+@tasks.loop(seconds=REFRESH_INTERVAL or 60)
+async def refresh_prices_task():
+    try:
+        await refresh_prices()
+    except (*NETWORK_ERRORS, ValueError) as error:
+        print(f'Price refresh failed: {error}')
+    except Exception:
+        # anything else would end the loop for good, log it and try again next interval
+        print('Price refresh crashed:')
+        traceback.print_exc()
+
+
+def guild_channel(guild_id: int | None):
+    """The channel set with !channel in that guild, DISCORD_TEST_CHANNEL_ID otherwise."""
+    channel_id = get_guild_channel(guild_id) if guild_id is not None else None
+    return bot.get_channel(channel_id or int(DISCORD_TEST_CHANNEL_ID))
+
+
+async def send_alerts(guild_id: int | None, messages: list[str]) -> None:
+    channel = guild_channel(guild_id)
+    if channel:
+        await channel.send("\n".join(messages)[:DISCORD_MESSAGE_LIMIT])
+
+
+@tasks.loop(seconds=REALTIME_INTERVAL or 60)
+async def realtime_feed_task():
+    if not market_open():
+        return
+    try:
+        await feed.poll(await tracked_codes())
+    except (*NETWORK_ERRORS, ValueError) as error:
+        print(f'Realtime poll failed: {error}')
+
+
+@tasks.loop(seconds=METRICS_INTERVAL)
+async def export_metrics_task():
+    try:
+        metrics.write_prometheus(METRICS_FILE)
+    except OSError as error:
+        print(f'Metrics export failed: {error}')
+
+
 @bot.event
 async def on_ready():
     print(f'Logged in as {bot.user}')
     init_db()
+    alert_engine.load()
+    alert_engine.notify = send_alerts
+    if REFRESH_INTERVAL and not refresh_prices_task.is_running():
+        refresh_prices_task.start()
+    if REALTIME_INTERVAL and not realtime_feed_task.is_running():
+        realtime_feed_task.start()
+    if METRICS_FILE and not export_metrics_task.is_running():
+        export_metrics_task.start()
     # await show_summary()
     # await show_own_list()
 
@@ -196,14 +216,142 @@ async def ping(ctx):
     aliases=['show_o', 'sol', 'show_own']
 )
 async def c_show_own_list(ctx):
-    await show_own_list(ctx)
+    await show_own_list(ctx, command_user(ctx))
 
 
 @bot.command(
     aliases=['show_sm', 'ssl']
 )
 async def c_show_summary(ctx):
-    await show_summary(ctx)
+    user, started = command_user(ctx), time.monotonic()
+    watch_list = await load_within_budget(get_watch_list(user), 'watch_list', user, started)
+    if len(watch_list) > PAGE_SIZE:
+        await SummaryPages(watch_list, ctx.author.id).send(ctx, started)
+    else:
+        await show_summary(ctx, user, watch_list, started)
+
+
+@bot.command(
+    aliases=['pf', 'show_pf']
+)
+async def c_show_portfolio(ctx):
+    await show_portfolio(ctx, command_user(ctx))
+
+
+@bot.command(name='scan')
+async def c_scan(ctx, *codes: str):
+    """!scan for the whole universe, or !scan <code> <code>... for a few symbols"""
+    try:
+        codes = [check_symbol(code) for code in codes]
+    except ValueError as error:
+        await ctx.send(str(error))
+        return
+    await show_scan(ctx, codes or None)
+
+
+@bot.command(name='chart')
+async def c_chart(ctx, code: str, length: str = '1Y'):
+    """!chart <code> [1M|3M|1Y|3Y], the close with min/max/root/sub root and your buy price"""
+    try:
+        code = check_symbol(code)
+        path = await chart_file(code, length.upper(), command_user(ctx))
+    except BrokenProcessPool as error:
+        # a render worker died, the next !chart starts a fresh pool
+        shutdown_pool()
+        await ctx.send(f'Chart failed: {error}')
+        return
+    except (*NETWORK_ERRORS, ValueError) as error:
+        await ctx.send(f'Chart failed: {error}')
+        return
+    await ctx.send(file=discord.File(path, filename=f'{code}_{length.upper()}.png'))
+
+
+@bot.command(name='stats')
+async def c_stats(ctx, action: str = None):
+    """!stats, or !stats reset to start counting afresh"""
+    if not await check_owner(ctx):
+        return
+    if action == 'reset':
+        metrics.reset()
+        await ctx.send('Metrics reset.')
+        return
+    await show_stats(ctx)
+
+
+@bot.command(name='register')
+async def c_register(ctx, username: str, password: str):
+    """!register <VPBanks username> <password>, in a direct message to the bot"""
+    if ctx.guild:
+        try:
+            await ctx.message.delete()
+        except discord.HTTPException:
+            pass
+        await ctx.send('Send your credentials to the bot in a direct message.')
+        return
+    try:
+        upsert_user({'id': ctx.author.id, 'username': username, 'password': password})
+    except ValueError as error:
+        await ctx.send(f'Registration failed: {error}')
+        return
+    forget_token_manager(ctx.author.id)
+    try:
+        await get_token_manager(ctx.author.id).refresh()
+    except (*NETWORK_ERRORS, ValueError) as error:
+        delete_user(ctx.author.id)
+        forget_token_manager(ctx.author.id)
+        await ctx.send(f'Login failed: {error}')
+        return
+    await ctx.send('Registered, sol / ssl / pf now show your own account.')
+
+
+@bot.command(name='unregister')
+async def c_unregister(ctx):
+    forget_token_manager(ctx.author.id)
+    await ctx.send('Unregistered.' if delete_user(ctx.author.id) else 'You are not registered.')
+
+
+@bot.command(name='channel')
+async def c_channel(ctx):
+    """!channel in the channel this guild's alerts should go to"""
+    if not await check_owner(ctx):
+        return
+    set_guild_channel(ctx.guild.id, ctx.channel.id)
+    await ctx.send('Alerts of this server are sent here.')
+
+
+@bot.group(name='alert', invoke_without_command=True)
+async def c_alert(ctx):
+    rules = [format_rule(rule) for rule in alert_engine.guild_rules(ctx.guild.id if ctx.guild else None)]
+    await ctx.send("\n".join(rules) if rules else 'No alert rules.')
+
+
+@c_alert.command(name='add')
+async def c_alert_add(ctx, code: str, kind: str, length: str = None, threshold: float = None):
+    """!alert add <code|*> <near_max|near_min|below_buy|reversal> [3M|1Y|3Y] [percent]"""
+    if not await check_owner(ctx):
+        return
+    try:
+        rule = alert_engine.add({
+            'id': 0,
+            'code': None if code == '*' else code.upper(),
+            'kind': kind,
+            'length': length.upper() if length else None,
+            'threshold': threshold,
+            'guild_id': ctx.guild.id,
+            'user_id': command_user(ctx),
+        })
+    except ValueError as error:
+        await ctx.send(str(error))
+        return
+    await ctx.send(f'Added {format_rule(rule)}')
+
+
+@c_alert.command(name='remove', aliases=['rm'])
+async def c_alert_remove(ctx, rule_id: int):
+    if not await check_owner(ctx):
+        return
+    await ctx.send(f'Removed #{rule_id}' if alert_engine.remove(rule_id, ctx.guild.id) else f'No rule #{rule_id}')
 
 
-bot.run(DISCORD_BOT_TOKEN)
+if __name__ == '__main__':
+    bot.run(DISCORD_BOT_TOKEN)
@@ -0,0 +1,102 @@
+import sys
+import time
+from datetime import date, datetime, timedelta, timezone
+
+VN_TIMEZONE = timezone(timedelta(hours=7))
+# HOSE order matching sessions in Vietnam time: morning (ATO + continuous) and afternoon (continuous + ATC)
+SESSIONS = (((9, 0), (11, 30)), ((13, 0), (14, 45)))
+# days the exchange is closed on a weekday, maintained by hand from the HOSE holiday notices
+HOLIDAYS = frozenset(date.fromisoformat(day) for day in (
+    '2024-01-01', '2024-02-08', '2024-02-09', '2024-02-12', '2024-02-13', '2024-02-14', '2024-04-18',
+    '2024-04-29', '2024-04-30', '2024-05-01', '2024-09-02', '2024-09-03',
+    '2025-01-01', '2025-01-27', '2025-01-28', '2025-01-29', '2025-01-30', '2025-01-31', '2025-04-07',
+    '2025-04-30', '2025-05-01', '2025-05-02', '2025-09-01', '2025-09-02',
+    '2026-01-01', '2026-01-02', '2026-02-16', '2026-02-17', '2026-02-18', '2026-02-19', '2026-02-20',
+    '2026-04-27', '2026-04-30', '2026-05-01', '2026-08-31', '2026-09-01', '2026-09-02',
+    '2027-01-01',
+))
+# years whose HOSE holiday notice is fully in HOLIDAYS. A warning is printed once for any other year up to next
+# year, further out (3Y min/max expiries) a missing holiday only moves an expiry years away by a day
+HOLIDAY_YEARS = frozenset((2024, 2025, 2026))
+_warned_years: set[int] = set()
+
+
+def local_time(timestamp: int | None = None) -> datetime:
+    return datetime.fromtimestamp(timestamp if timestamp is not None else int(time.time()), VN_TIMEZONE)
+
+
+def is_trading_day(day: date) -> bool:
+    if day.year not in HOLIDAY_YEARS and day.year not in _warned_years and day.year <= local_time().year + 1:
+        _warned_years.add(day.year)
+        print(f'market.HOLIDAYS has no {day.year} holidays yet, every weekday of {day.year} counts as a trading day',
+              file=sys.stderr)
+    return day.weekday() < 5 and day not in HOLIDAYS
+
+
+def session_time(day: date, hour: int, minute: int) -> int:
+    return int(datetime(day.year, day.month, day.day, hour, minute, tzinfo=VN_TIMEZONE).timestamp())
+
+
+def session_close(day: date) -> int:
+    (_, (hour, minute)) = SESSIONS[-1]
+    return session_time(day, hour, minute)
+
+
+def market_open(timestamp: int | None = None) -> bool:
+    """Inside one of today's order matching sessions on a trading day."""
+    current = local_time(timestamp)
+    if not is_trading_day(current.date()):
+        return False
+    moment = int(current.timestamp())
+    return any(session_time(current.date(), *start) <= moment < session_time(current.date(), *end)
+               for start, end in SESSIONS)
+
+
+def next_trading_day(day: date) -> date:
+    day += timedelta(days=1)
+    while not is_trading_day(day):
+        day += timedelta(days=1)
+    return day
+
+
+def next_session_open(timestamp: int | None = None) -> int:
+    """Start of the first trading day's morning session strictly after `timestamp`."""
+    current = local_time(timestamp)
+    day = current.date()
+    ((hour, minute), _) = SESSIONS[0]
+    if not is_trading_day(day) or session_time(day, hour, minute) <= current.timestamp():
+        day = next_trading_day(day)
+    return session_time(day, hour, minute)
+
+
+def next_session_start(timestamp: int | None = None) -> int:
+    """Start of the first session strictly after `timestamp`, the afternoon one included: during the lunch
+    break that is 13:00 the same day.
+
+    >>> lunch = session_time(date(2026, 10, 19), 12, 0)
+    >>> local_time(next_session_start(lunch)).strftime('%Y-%m-%d %H:%M')
+    '2026-10-19 13:00'
+    """
+    current = local_time(timestamp)
+    day = current.date()
+    if is_trading_day(day):
+        for start, _ in SESSIONS:
+            if session_time(day, *start) > current.timestamp():
+                return session_time(day, *start)
+    return next_session_open(timestamp)
+
+
+def next_price_change(timestamp: int | None = None) -> int:
+    """When a last price read at `timestamp` can next move: today's closing bell while a trading day is
+    under way, otherwise the next morning session's open."""
+    return min(next_session_open(timestamp), next_session_close(timestamp))
+
+
+def next_session_close(timestamp: int | None = None) -> int:
+    """The first closing bell at or after `timestamp`: today's while the trading day has not closed yet,
+    otherwise the next trading day's. Expiries snapped to it never fall on a weekend or holiday."""
+    current = local_time(timestamp)
+    day = current.date()
+    if not is_trading_day(day) or session_close(day) < current.timestamp():
+        day = next_trading_day(day)
+    return session_close(day)
@@ -0,0 +1,170 @@
+import functools
+import os
+import re
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Iterator
+
+from cache import LRUCache
+
+Labels = tuple[tuple[str, str], ...]
+# upper bounds in seconds, doubling from 0.1ms to ~105s; the last bucket catches everything slower
+BUCKETS = tuple(0.0001 * 2 ** index for index in range(21))
+PROMETHEUS_PREFIX = 'stock_'
+
+
+class Histogram:
+    """Fixed exponential buckets: observing is a bisect and two additions, quantiles are estimated
+    by interpolating inside the bucket the rank falls in."""
+
+    def __init__(self, bounds: tuple[float, ...] = BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[index - 1] if index else 0.0
+                upper = self.bounds[index] if index < len(self.bounds) else lower * 2
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+
+class Metrics:
+    """In-memory counters and latency histograms keyed by name and labels, plus the LRU caches whose
+    hit/miss counts are reported alongside them."""
+
+    def __init__(self):
+        self.counters: dict[tuple[str, Labels], float] = {}
+        self.histograms: dict[tuple[str, Labels], Histogram] = {}
+        self.caches: dict[str, LRUCache] = {}
+        self.started = time.time()
+
+    def count(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, name: str, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name: str):
+        """Decorator recording every call of a coroutine function as a `name` span."""
+        def decorator(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return await function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def watch_cache(self, name: str, cache: LRUCache) -> None:
+        self.caches[name] = cache
+
+    def reset(self) -> None:
+        self.counters.clear()
+        self.histograms.clear()
+        for cache in self.caches.values():
+            cache.hits = cache.misses = 0
+        self.started = time.time()
+
+    def latency_rows(self) -> list[dict[str, str]]:
+        return [{
+            'Span': name,
+            'Labels': format_labels_short(labels),
+            'Count': str(histogram.count),
+            'p50 ms': f'{histogram.quantile(0.5) * 1000:.1f}',
+            'p99 ms': f'{histogram.quantile(0.99) * 1000:.1f}',
+            'Total s': f'{histogram.sum:.2f}',
+        } for (name, labels), histogram in sorted(self.histograms.items())]
+
+    def counter_rows(self) -> list[dict[str, str]]:
+        rows = [{'Counter': name, 'Labels': format_labels_short(labels), 'Value': f'{value:g}'}
+                for (name, labels), value in sorted(self.counters.items())]
+        for name, cache in self.caches.items():
+            lookups = cache.hits + cache.misses
+            hit_rate = f'{cache.hits / lookups * 100:.0f}%' if lookups else '-'
+            rows.append({'Counter': 'cache', 'Labels': f'cache={name}',
+                         'Value': f'{cache.hits}/{lookups} hit {hit_rate}, size {len(cache)}'})
+        return rows
+
+    def prometheus_text(self) -> str:
+        lines = []
+        for name, series in group_by_name(self.counters).items():
+            metric = prometheus_name(name) + '_total'
+            lines.append(f'# TYPE {metric} counter')
+            lines.extend(f'{metric}{format_labels(labels)} {value:g}' for labels, value in series)
+        for name, series in group_by_name(self.histograms).items():
+            metric = prometheus_name(name) + '_seconds'
+            lines.append(f'# TYPE {metric} histogram')
+            for labels, histogram in series:
+                cumulative = 0
+                for bound, count in zip((*histogram.bounds, float('inf')), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                    lines.append(f'{metric}_bucket{format_labels((*labels, ("le", le)))} {cumulative}')
+                lines.append(f'{metric}_sum{format_labels(labels)} {histogram.sum:g}')
+                lines.append(f'{metric}_count{format_labels(labels)} {histogram.count}')
+        for field in ('hits', 'misses'):
+            metric = f'{PROMETHEUS_PREFIX}cache_{field}_total'
+            lines.append(f'# TYPE {metric} counter')
+            lines.extend(f'{metric}{{cache="{name}"}} {getattr(cache, field)}' for name, cache in self.caches.items())
+        metric = f'{PROMETHEUS_PREFIX}cache_size'
+        lines.append(f'# TYPE {metric} gauge')
+        lines.extend(f'{metric}{{cache="{name}"}} {len(cache)}' for name, cache in self.caches.items())
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str) -> None:
+        """Written whole and renamed into place, so a textfile collector never reads half a file."""
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as file:
+            file.write(self.prometheus_text())
+        os.replace(temporary, path)
+
+
+def group_by_name(series: dict) -> dict[str, list]:
+    grouped = {}
+    for (name, labels), value in sorted(series.items()):
+        grouped.setdefault(name, []).append((labels, value))
+    return grouped
+
+
+def prometheus_name(name: str) -> str:
+    return PROMETHEUS_PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def format_labels_short(labels: Labels) -> str:
+    return ' '.join(f'{key}={value}' for key, value in labels)
+
+
+metrics = Metrics()
@@ -0,0 +1,179 @@
+"""Local stand-in for the VPBanks endpoints the bot calls, for benchmarks and offline runs.
+
+Serves synthetic responses (a deterministic random walk per symbol) or, when a fixtures directory is given,
+recorded ones stored as <fixtures>/<endpoint family>/<name>.json, e.g. price_chart/VNM_3Y.json,
+watch_list/watch_list.json. Every response is delayed by `latency` seconds.
+
+    python mock_server.py --port 8765 --symbols 100 --latency 0.05
+    BASE_URL=http://127.0.0.1:8765 python main.py
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import web
+
+from constant import endpoint_family
+
+CHART_DAYS = {'1W': 7, '1M': 30, '3M': 90, '1Y': 365, '3Y': 3 * 365}
+ACCOUNT_ID = 1
+
+
+def symbol_names(count: int) -> list[str]:
+    return [f'S{index:04d}' for index in range(count)]
+
+
+class MockServer:
+    def __init__(self, symbols: list[str], latency: float = 0.0, fixtures: str | None = None,
+                 host: str = '127.0.0.1', port: int = 8765):
+        self.symbols = symbols
+        self.latency = latency
+        self.fixtures = fixtures
+        self.host = host
+        self.port = port
+        self.requests: dict[str, int] = {}
+        self.bytes_sent = 0
+        self._charts: dict[str, list[dict]] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._runner: web.AppRunner | None = None
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    def reset_counters(self) -> None:
+        self.requests = {}
+        self.bytes_sent = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/invest/api/stock/getPriceChartLine', self.price_chart)
+        app.router.add_get('/invest/api/getPriceByList/5min', self.realtime_price)
+        app.router.add_post('/auth/token', self.login)
+        app.router.add_get('/flex/userdata/watchlists', self.watch_list)
+        app.router.add_get('/flex/accountsAll', self.account_list)
+        app.router.add_get('/flex/inq/accounts/{account_id}/securitiesPortfolio', self.own_list)
+        return app
+
+    async def respond(self, request: web.Request, payload) -> web.Response:
+        family = endpoint_family(request.path)
+        self.requests[family] = self.requests.get(family, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        body = json.dumps(payload).encode()
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        self.bytes_sent += len(body)
+        return web.Response(body=body, content_type='application/json', headers={'ETag': etag})
+
+    def fixture(self, family: str, name: str):
+        if not self.fixtures:
+            return None
+        path = os.path.join(self.fixtures, family, f'{name}.json')
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+
+    def chart(self, code: str) -> list[dict]:
+        """Three years of daily bars ending today, the same for a symbol on every run."""
+        if code not in self._charts:
+            rnd = random.Random(code)
+            today = datetime.now(timezone.utc).replace(hour=17, minute=0, second=0, microsecond=0)
+            days = [today - timedelta(days=offset) for offset in range(CHART_DAYS['3Y'], -1, -1)]
+            price = rnd.uniform(10000, 100000)
+            prices = []
+            for day in days:
+                if day.weekday() >= 5:
+                    continue
+                open_price = price
+                price = round(price * (1 + rnd.uniform(-0.03, 0.03)), -1)
+                prices.append({
+                    'TradingDate': day.strftime('%Y-%m-%dT%H:%MZ'),
+                    'OpenPrice': open_price,
+                    'HighestPrice': max(open_price, price),
+                    'LowestPrice': min(open_price, price),
+                    'ClosePrice': price,
+                    'TotalVolume': rnd.randint(10000, 1000000),
+                })
+            self._charts[code] = prices
+        return self._charts[code]
+
+    async def price_chart(self, request: web.Request) -> web.Response:
+        code, chart_type = request.query['symbol'], request.query['chartType']
+        payload = self.fixture('price_chart', f'{code}_{chart_type}')
+        if payload is None:
+            since = (datetime.now(timezone.utc) - timedelta(days=CHART_DAYS[chart_type])).strftime('%Y-%m-%d')
+            payload = {'PriceHistory': [price for price in self.chart(code) if price['TradingDate'] >= since]}
+        return await self.respond(request, payload)
+
+    async def realtime_price(self, request: web.Request) -> web.Response:
+        codes = request.query['symbolList'].split(',')
+        payload = self.fixture('realtime_price', 'realtime_price')
+        if payload is None:
+            payload = {'data': [{'symbol': code, 'lastPrice': self.chart(code)[-1]['ClosePrice']} for code in codes]}
+        return await self.respond(request, payload)
+
+    async def login(self, request: web.Request) -> web.Response:
+        await request.read()
+        return await self.respond(request, {'data': {'access_token': 'mock-token', 'expires_in': 3600}})
+
+    async def watch_list(self, request: web.Request) -> web.Response:
+        payload = self.fixture('watch_list', 'watch_list') or {'d': [{'symbols': self.symbols}]}
+        return await self.respond(request, payload)
+
+    async def account_list(self, request: web.Request) -> web.Response:
+        payload = self.fixture('account_list', 'account_list') or {'d': [{'producttype': 'NN', 'id': ACCOUNT_ID}]}
+        return await self.respond(request, payload)
+
+    async def own_list(self, request: web.Request) -> web.Response:
+        payload = self.fixture('own_list', 'own_list')
+        if payload is None:
+            payload = {'d': [
+                {'symbol': code, 'total': 100 * (index + 1), 'trade': 100 * (index + 1),
+                 'costPrice': self.chart(code)[len(self.chart(code)) // 2]['ClosePrice']}
+                for index, code in enumerate(self.symbols)
+            ]}
+        return await self.respond(request, payload)
+
+    async def serve(self) -> None:
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    def start(self) -> None:
+        """Serve from a background thread with its own event loop, so the server's work is not timed
+        as part of the client it is measured against."""
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.serve())
+            started.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+
+    def stop(self) -> None:
+        if self._loop:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--symbols', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--fixtures', help='directory of recorded responses')
+    args = parser.parse_args()
+    server = MockServer(symbol_names(args.symbols), args.latency, args.fixtures, args.host, args.port)
+    web.run_app(server.app(), host=args.host, port=args.port, access_log=None)
@@ -0,0 +1,165 @@
+import asyncio
+import math
+import time
+
+import discord
+
+from constant import PAGE_SIZE, PAGE_TIMEOUT, PAGE_ORDERING_TTL, DISCORD_MESSAGE_LIMIT
+from db import get_price_record
+from formatting import summary_table, summary_title
+from metrics import metrics
+from render import render_table
+from services import prefetch_prices, price_snapshot, finish_refresh, refresh_within_budget, revalidate
+
+INF = float('inf')
+
+
+def price(code: str, price_type, length=None) -> float | None:
+    record = get_price_record(code, price_type, length, allow_stale=True)
+    return record['price'] if record else None
+
+
+def change_from_root(code: str) -> float:
+    """Negated so the biggest gain since the root sorts first, unknown symbols last."""
+    last, root = price(code, 'last'), price(code, 'root')
+    return -(last - root) / root if last is not None and root else INF
+
+
+def distance_to_max(length: str):
+    def key(code: str) -> float:
+        last, high = price(code, 'last'), price(code, 'max', length)
+        return (high - last) / last if last and high is not None else INF
+    return key
+
+
+# button label -> sort key over the stored (possibly stale) prices, None keeps the watch list order
+SORTS = {
+    'List': None,
+    'Last %': change_from_root,
+    'Max 3M': distance_to_max('3M'),
+    'Max 1Y': distance_to_max('1Y'),
+    'Max 3Y': distance_to_max('3Y'),
+}
+
+
+class SummaryPages(discord.ui.View):
+    """The ssl table one page at a time: only the symbols on the page shown are refreshed and rendered,
+    the next page is prefetched meanwhile. Sorting reads the db alone, so it never waits on the network,
+    and each order is reused for PAGE_ORDERING_TTL seconds."""
+
+    def __init__(self, codes: list[str], owner_id: int, page_size: int = PAGE_SIZE):
+        super().__init__(timeout=PAGE_TIMEOUT)
+        self.codes = codes
+        self.owner_id = owner_id
+        self.page_size = page_size
+        self.page = 0
+        self.sort = 'List'
+        self.orderings: dict[str, tuple[float, list[str]]] = {}
+        self.message: discord.Message | None = None
+        # prefetches and revalidations in flight, referenced so they are not garbage collected
+        self.tasks: set[asyncio.Task] = set()
+        for label in SORTS:
+            button = discord.ui.Button(label=label, row=1, custom_id=f'sort:{label}')
+            button.callback = self.sort_callback(label)
+            self.add_item(button)
+
+    def page_count(self) -> int:
+        return max(1, math.ceil(len(self.codes) / self.page_size))
+
+    def ordering(self) -> list[str]:
+        cached = self.orderings.get(self.sort)
+        if cached and time.monotonic() - cached[0] < PAGE_ORDERING_TTL:
+            return cached[1]
+        key = SORTS[self.sort]
+        with metrics.span('pages.sort'):
+            codes = sorted(self.codes, key=key) if key else self.codes
+        self.orderings[self.sort] = (time.monotonic(), codes)
+        return codes
+
+    def page_codes(self, page: int) -> list[str]:
+        return self.ordering()[page * self.page_size:(page + 1) * self.page_size]
+
+    def content(self, codes: list[str]) -> str:
+        """The page as a single message like !ssl renders it, with a page footer. Rows too wide for
+        page_size of them to fit one message shrink the pages from then on."""
+        while True:
+            footer = f'\nPage {self.page + 1}/{self.page_count()}, sorted by {self.sort}'
+            table = summary_table([price_snapshot(code) for code in codes])
+            messages = render_table(table, summary_title(), DISCORD_MESSAGE_LIMIT - len(footer))
+            if len(messages) == 1 or self.page_size == 1:
+                return messages[0] + footer
+            metrics.count('pages.shrink')
+            first = self.page * self.page_size
+            self.page_size -= 1
+            self.page = first // self.page_size
+            codes = self.page_codes(self.page)
+            self.update_buttons()
+
+    def spawn(self, coroutine) -> None:
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def render(self, started: float | None = None) -> str:
+        """The current page once its symbols are refreshed or the budget of the command (or button press)
+        that started at `started` runs out, a refresh still running edits the message once it completes."""
+        codes = self.page_codes(self.page)
+        self.update_buttons()
+        refresh = await refresh_within_budget(codes, started or time.monotonic())
+        if refresh:
+            page = self.page
+            self.spawn(revalidate(refresh, lambda: self.edit_page(page, codes)))
+        if self.page + 1 < self.page_count():
+            self.spawn(finish_refresh(prefetch_prices(self.page_codes(self.page + 1))))
+        return self.content(codes)
+
+    async def edit_page(self, page: int, codes: list[str]) -> None:
+        if self.message and (self.page, self.page_codes(page)) == (page, codes):
+            await self.message.edit(content=self.content(codes), view=self)
+
+    def update_buttons(self) -> None:
+        self.previous.disabled = self.page == 0
+        self.next.disabled = self.page + 1 >= self.page_count()
+        for item in self.children:
+            if isinstance(item, discord.ui.Button) and item.custom_id and item.custom_id.startswith('sort:'):
+                item.style = discord.ButtonStyle.primary if item.label == self.sort else discord.ButtonStyle.secondary
+
+    async def send(self, channel, started: float | None = None) -> None:
+        """`started` when the command already spent part of its budget, loading the watch list."""
+        self.message = await channel.send(await self.render(started), view=self)
+
+    async def show(self, interaction: discord.Interaction) -> None:
+        # rendering may take up to the budget, longer than discord waits for an answer
+        await interaction.response.defer()
+        await interaction.edit_original_response(content=await self.render(), view=self)
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.user.id != self.owner_id:
+            await interaction.response.send_message('Run !ssl to page through your own watch list.', ephemeral=True)
+            return False
+        return True
+
+    async def on_timeout(self) -> None:
+        for item in self.children:
+            item.disabled = True
+        if self.message:
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass
+
+    @discord.ui.button(label='◀', row=0)
+    async def previous(self, interaction: discord.Interaction, _):
+        self.page = max(0, self.page - 1)
+        await self.show(interaction)
+
+    @discord.ui.button(label='▶', row=0)
+    async def next(self, interaction: discord.Interaction, _):
+        self.page = min(self.page_count() - 1, self.page + 1)
+        await self.show(interaction)
+
+    def sort_callback(self, label: str):
+        async def callback(interaction: discord.Interaction):
+            self.sort, self.page = label, 0
+            await self.show(interaction)
+        return callback
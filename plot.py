@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from api import NETWORK_ERRORS
+from constant import CHART_DIR, CHART_CACHE_SIZE, CHART_LENGTHS, CHART_WORKERS, DEFAULT_USER
+from db import get_price_record
+from history import PriceSeries
+from metrics import metrics
+from services import get_price_series, get_root_price, get_own_list, format_price
+
+# overlay -> (line color, line style)
+OVERLAY_STYLES = {
+    'min': ('tab:red', '--'),
+    'max': ('tab:green', '--'),
+    'root': ('tab:purple', '-.'),
+    'sub root': ('tab:orange', ':'),
+    'buy price': ('tab:blue', '-'),
+}
+_pool: ProcessPoolExecutor | None = None
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=CHART_WORKERS)
+    return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def render_chart(code: str, length: str, timestamps: np.ndarray, closes: np.ndarray,
+                 overlays: dict[str, float]) -> bytes:
+    """Runs in a worker process: the close line of one window (thousand VND, like the overlays) with a
+    horizontal line per overlay, as PNG. matplotlib is imported here so the bot process never loads it."""
+    import io
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import dates, pyplot
+
+    figure, axes = pyplot.subplots(figsize=(10, 5), dpi=100)
+    try:
+        days = timestamps.astype('datetime64[s]')
+        axes.plot(days, closes, color='black', linewidth=1.2, label=f'{code} close')
+        for name, price in overlays.items():
+            color, style = OVERLAY_STYLES[name]
+            axes.axhline(price, color=color, linestyle=style, linewidth=1, label=f'{name} {price:.2f}')
+        axes.set_title(f'{code} {length}')
+        axes.set_ylabel('thousand VND')
+        axes.xaxis.set_major_formatter(dates.ConciseDateFormatter(axes.xaxis.get_major_locator()))
+        axes.grid(alpha=0.3)
+        axes.legend(loc='upper left', fontsize='small')
+        figure.tight_layout()
+        buffer = io.BytesIO()
+        figure.savefig(buffer, format='png')
+        return buffer.getvalue()
+    finally:
+        pyplot.close(figure)
+
+
+def chart_digest(code: str, length: str, window: PriceSeries, overlays: dict[str, float]) -> str:
+    """Content address of a chart: identical rows and overlays always render the same image."""
+    digest = hashlib.sha256(f'{code}:{length}:'.encode())
+    digest.update(np.ascontiguousarray(window.records).tobytes())
+    digest.update(json.dumps(overlays, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def prune_charts(directory: str = CHART_DIR, keep: int = CHART_CACHE_SIZE) -> None:
+    """Drop the least recently served images beyond `keep`."""
+    paths = [entry.path for entry in os.scandir(directory) if entry.name.endswith('.png')]
+    if len(paths) <= keep:
+        return
+    paths.sort(key=os.path.getmtime)
+    for path in paths[:len(paths) - keep]:
+        os.remove(path)
+
+
+async def chart_overlays(code: str, window: PriceSeries, user: int) -> dict[str, float]:
+    """min/max of the window, the stored root/sub root and the user's buy price when they hold the symbol."""
+    (_, low), (_, high) = window.extremes()
+    overlays = {'min': format_price(low), 'max': format_price(high), 'root': await get_root_price(code)}
+    sub_root = get_price_record(code, 'sub root', None)
+    if sub_root:
+        overlays['sub root'] = sub_root['price']
+    try:
+        own_list = await get_own_list(user)
+    except (*NETWORK_ERRORS, ValueError):
+        own_list = []
+    for stock in own_list:
+        if stock['code'] == code:
+            overlays['buy price'] = stock['buy_price']
+    return overlays
+
+
+@metrics.timed('plot.chart_file')
+async def chart_file(code: str, length: str, user: int = DEFAULT_USER) -> str:
+    """Path of the PNG for `code` over `length`, rendered in the process pool unless an image of the
+    same rows and overlays is already on disk."""
+    if length not in CHART_LENGTHS:
+        raise ValueError(f"Invalid chart length: {length}, expected one of {', '.join(CHART_LENGTHS)}")
+    window = (await get_price_series(code, length)).window(length)
+    overlays = await chart_overlays(code, window, user)
+    path = os.path.join(CHART_DIR, f'{chart_digest(code, length, window, overlays)}.png')
+
+    if os.path.exists(path):
+        metrics.count('chart_cache', result='hit')
+        os.utime(path)
+        return path
+
+    metrics.count('chart_cache', result='miss')
+    with metrics.span('plot.render'):
+        image = await asyncio.get_running_loop().run_in_executor(
+            get_pool(), render_chart, code, length, np.array(window.timestamps), window.closes / 1000, overlays
+        )
+    os.makedirs(CHART_DIR, exist_ok=True)
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(image)
+    os.replace(temporary, path)
+    prune_charts()
+    return path
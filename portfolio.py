@@ -0,0 +1,72 @@
+import numpy as np
+
+from constant import DEFAULT_USER
+from services import get_own_list, prefetch_prices, get_last_price, get_min_max_price
+from type import OwnStock
+
+
+class Portfolio:
+    """Column arrays over all holdings, prices in thousand VND like every other price in the db."""
+
+    def __init__(self, codes: list[str], total: np.ndarray, buy_price: np.ndarray, last: np.ndarray,
+                 max_1y: np.ndarray, max_3y: np.ndarray):
+        self.codes = codes
+        self.total = total
+        self.buy_price = buy_price
+        self.last = last
+        self.max_1y = max_1y
+        self.max_3y = max_3y
+
+        self.cost = total * buy_price
+        self.value = total * last
+        self.pnl = self.value - self.cost
+        self.pnl_percent = np.divide(self.pnl, self.cost, out=np.zeros_like(self.pnl), where=self.cost > 0) * 100
+        total_value = self.value.sum()
+        self.weight = self.value / total_value * 100 if total_value else np.zeros_like(self.value)
+        self.drawdown_1y = (last / max_1y - 1) * 100
+        self.drawdown_3y = (last / max_3y - 1) * 100
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def totals(self) -> dict[str, float]:
+        cost, value = float(self.cost.sum()), float(self.value.sum())
+        return {
+            'cost': cost,
+            'value': value,
+            'pnl': value - cost,
+            'pnl_percent': (value - cost) / cost * 100 if cost else 0.0,
+            # value-weighted distance of the holdings from their highs
+            'drawdown_1y': float(self.weight @ self.drawdown_1y / 100),
+            'drawdown_3y': float(self.weight @ self.drawdown_3y / 100),
+        }
+
+    def to_dict(self) -> dict:
+        columns = ('total', 'buy_price', 'last', 'max_1y', 'max_3y', 'cost', 'value', 'pnl', 'pnl_percent', 'weight',
+                   'drawdown_1y', 'drawdown_3y')
+        holdings = [{'code': code, **{column: float(getattr(self, column)[index]) for column in columns}}
+                    for index, code in enumerate(self.codes)]
+        return {'holdings': holdings, 'totals': self.totals()}
+
+
+async def load_portfolio(own_list: list[OwnStock] | None = None, user: int = DEFAULT_USER) -> Portfolio:
+    """All holdings' prices are loaded in one batch, then every metric is computed column-wise."""
+    if own_list is None:
+        own_list = await get_own_list(user)
+    codes = [stock['code'] for stock in own_list]
+    await prefetch_prices(codes, ('1Y', '3Y'))
+
+    last, max_1y, max_3y = [], [], []
+    for code in codes:
+        last.append(await get_last_price(code))
+        max_1y.append((await get_min_max_price(code, '1Y'))[1])
+        max_3y.append((await get_min_max_price(code, '3Y'))[1])
+
+    return Portfolio(
+        codes,
+        np.array([stock['total'] for stock in own_list], dtype=np.float64),
+        np.array([stock['buy_price'] for stock in own_list], dtype=np.float64),
+        np.array(last, dtype=np.float64),
+        np.array(max_1y, dtype=np.float64),
+        np.array(max_3y, dtype=np.float64),
+    )
@@ -0,0 +1,41 @@
+from typing import Awaitable, Callable, Iterable
+
+from services import fetch_realtime_prices, format_price, save_last_price, advance_root_price, advance_min_max_price
+
+Subscriber = Callable[[dict[str, float]], Awaitable[None]]
+
+
+class RealtimeFeed:
+    """Latest price per symbol from getPriceByList, subscribers only hear about symbols whose price moved."""
+
+    def __init__(self):
+        self.ticks: dict[str, float] = {}
+        self.subscribers: list[Subscriber] = []
+
+    def subscribe(self, subscriber: Subscriber) -> None:
+        self.subscribers.append(subscriber)
+
+    async def poll(self, codes: Iterable[str]) -> dict[str, float]:
+        prices = await fetch_realtime_prices(codes)
+        changed = {}
+        for code, price in prices.items():
+            price = format_price(price)
+            if self.ticks.get(code) != price:
+                changed[code] = price
+        self.ticks.update(changed)
+
+        if changed:
+            for subscriber in self.subscribers:
+                await subscriber(changed)
+        return changed
+
+
+async def track_prices(changed: dict[str, float]) -> None:
+    for code, price in changed.items():
+        save_last_price(code, price)
+        advance_root_price(code, price)
+        advance_min_max_price(code, price)
+
+
+feed = RealtimeFeed()
+feed.subscribe(track_prices)
@@ -0,0 +1,98 @@
+import re
+from functools import lru_cache
+
+from constant import DISCORD_MESSAGE_LIMIT
+from metrics import metrics
+
+ANSI_ESCAPE = re.compile(r'\x1B\[[0-;]*[mK]')
+CODE_BLOCK_START = '```ansi\n'
+CODE_BLOCK_END = '```'
+
+
+@lru_cache(maxsize=4096)
+def visible_length(s: str) -> int:
+    return len(ANSI_ESCAPE.sub('', s)) if '\x1b' in s else len(s)
+
+
+def custom_ljust(s: str, width: int) -> str:
+    needed = width - visible_length(s)
+    return s + ' ' * needed
+
+
+def render_rows(table: list[dict[str, str]]) -> tuple[str, list[str]]:
+    """Header and one padded line per row, measuring every cell exactly once."""
+    labels = list(table[0].keys())
+    cells = [[str(item[key]) for key in labels] for item in table]
+    widths = [[visible_length(cell) for cell in row] for row in cells]
+    column_widths = [max(len(label), *(row[index] for row in widths)) for index, label in enumerate(labels)]
+
+    header = " | ".join(label.ljust(width) for label, width in zip(labels, column_widths))
+    rows = [
+        " | ".join(cell + ' ' * (column_width - width) for cell, width, column_width in zip(row, row_widths, column_widths))
+        for row, row_widths in zip(cells, widths)
+    ]
+    return header, rows
+
+
+def code_block(lines: list[str]) -> str:
+    return CODE_BLOCK_START + "\n".join(lines) + "\n" + CODE_BLOCK_END
+
+
+def split_messages(title: str, header: str, rows: list[str], limit: int = DISCORD_MESSAGE_LIMIT) -> list[str]:
+    """Code blocks of at most `limit` characters, the title opens the first one and every one repeats the header."""
+    wrapper = len(CODE_BLOCK_START) + len(CODE_BLOCK_END)
+    messages = []
+    lines = [title, header]
+    size = wrapper + len(title) + len(header) + 2
+    for row in rows:
+        if size + len(row) + 1 > limit and lines[-1] is not header:
+            messages.append(code_block(lines))
+            lines = [header]
+            size = wrapper + len(header) + 1
+        lines.append(row)
+        size += len(row) + 1
+    messages.append(code_block(lines))
+    return messages
+
+
+def render_table(table: list[dict[str, str]], title: str, limit: int = DISCORD_MESSAGE_LIMIT) -> list[str]:
+    header, rows = render_rows(table)
+    return split_messages(title, header, rows, limit)
+
+
+class PostedTable:
+    def __init__(self, messages: list, contents: list[str]):
+        self.messages = messages
+        self.contents = contents
+
+
+# last table posted per (channel id, title), so a refresh can edit it instead of posting again
+posted_tables: dict[tuple[int, str], PostedTable] = {}
+
+
+def channel_key(channel) -> int:
+    return getattr(channel, 'channel', channel).id
+
+
+async def send_table(channel, table: list[dict[str, str]], title: str, edit: bool = False) -> None:
+    """Post the table split into message-sized code blocks. With `edit`, the table previously posted
+    under the same title in this channel is updated in place: only messages whose rows changed are edited."""
+    with metrics.span('render.table'):
+        contents = render_table(table, title)
+    key = (channel_key(channel), title)
+    posted = posted_tables.get(key) if edit else None
+
+    messages = []
+    for index, content in enumerate(contents):
+        if posted and index < len(posted.messages):
+            message = posted.messages[index]
+            if posted.contents[index] != content:
+                message = await message.edit(content=content) or message
+            messages.append(message)
+        else:
+            messages.append(await channel.send(content))
+    if posted:
+        for message in posted.messages[len(contents):]:
+            await message.delete()
+
+    posted_tables[key] = PostedTable(messages, contents)
@@ -0,0 +1,99 @@
+import asyncio
+import os
+import re
+import sys
+from bisect import insort
+from typing import AsyncIterator, Iterable
+
+from constant import SCAN_UNIVERSE_FILE, SCAN_NEAR_PERCENT, SCAN_LENGTHS, HISTORY_CHART_TYPE, VN30
+from history import PriceSeries
+from metrics import metrics
+from services import format_price, get_price_series
+
+
+def load_universe(path: str = SCAN_UNIVERSE_FILE) -> list[str]:
+    if not os.path.exists(path):
+        return list(VN30)
+    with open(path, encoding='utf-8') as file:
+        text = re.sub(r'#.*', '', file.read())
+        codes = [code.upper() for code in re.split(r'[\s,]+', text) if code]
+    return list(dict.fromkeys(codes))
+
+
+def analyse_chart(code: str, series: PriceSeries, lengths: tuple[str, ...]) -> dict:
+    """The figures a scan ranks by, from one symbol's stored series.
+
+    above_min_<length> is how far the last close sits above the window's low, in percent, using the same
+    windows as services.fetch_min_max_price. reversal is set when the last close moved the 1M root, the
+    event the reversal alert fires on."""
+    last = series.last
+    result = {'code': code, 'last': format_price(last)}
+    for length in lengths:
+        (_, low), (_, high) = series.window(length).extremes()
+        if low <= 0:
+            raise ValueError(f'{code}: non-positive {length} low {low}')
+        key = length.lower()
+        result[f'min_{key}'] = format_price(low)
+        result[f'max_{key}'] = format_price(high)
+        result[f'above_min_{key}'] = (last - low) / low * 100
+
+    month = series.window('1M')
+    root, sub_root = month.root_and_sub_root()
+    previous = PriceSeries(month.records[:-1])
+    result['root'] = format_price(root)
+    result['sub_root'] = format_price(sub_root)
+    result['reversal'] = len(previous) >= 2 and previous.root_and_sub_root()[0] != root
+    result['score'] = min(result[f'above_min_{length.lower()}'] for length in lengths)
+    return result
+
+
+def scan_rank(result: dict) -> float:
+    return result['score']
+
+
+class Scan:
+    """One pass over a universe: series come concurrently from the history store, which downloads only
+    missing or stale charts through the rate limited client, and each is analysed in place (a few argmin /
+    argmax calls over numpy columns). Matches are yielded as they complete and kept in `ranking`, closest
+    to a low first."""
+
+    def __init__(self, codes: Iterable[str], threshold: float = SCAN_NEAR_PERCENT,
+                 lengths: tuple[str, ...] = SCAN_LENGTHS):
+        self.codes = list(dict.fromkeys(codes))
+        self.threshold = threshold
+        self.lengths = lengths
+        self.done = 0
+        self.failed = 0
+        self.ranking: list[dict] = []
+
+    def progress(self) -> str:
+        return f'{self.done + self.failed}/{len(self.codes)} scanned, {len(self.ranking)} matches, {self.failed} failed'
+
+    def matches(self, result: dict) -> bool:
+        return result['score'] <= self.threshold or result['reversal']
+
+    async def analyse(self, code: str) -> dict:
+        # through the history store and http cache, so a repeated scan only downloads tails of stale symbols
+        series = await get_price_series(code, HISTORY_CHART_TYPE)
+        with metrics.span('scan.analyse'):
+            return analyse_chart(code, series, self.lengths)
+
+    async def results(self) -> AsyncIterator[dict]:
+        tasks = [asyncio.ensure_future(self.analyse(code)) for code in self.codes]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    result = await next_done
+                except Exception as error:
+                    # anything one symbol's download or analysis raises only skips that symbol
+                    self.failed += 1
+                    metrics.count('scan.errors')
+                    print(f'Scan skipped a symbol: {error!r}', file=sys.stderr)
+                    continue
+                self.done += 1
+                if self.matches(result):
+                    insort(self.ranking, result, key=scan_rank)
+                    yield result
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,35 @@
+import asyncio
+import random
+
+from api import NETWORK_ERRORS
+from constant import REFRESH_AHEAD, REFRESH_BATCH_SIZE, REFRESH_JITTER
+from db import list_user_ids
+from services import get_watch_list, get_own_list, prefetch_prices
+
+
+async def user_codes(user: int) -> list[str]:
+    watch_list = await get_watch_list(user)
+    own_list = await get_own_list(user)
+    return [*watch_list, *(stock['code'] for stock in own_list)]
+
+
+async def tracked_codes() -> list[str]:
+    """Union of every user's watch list and own list, so a symbol many users follow is fetched once.
+    A user whose account cannot be read right now is skipped rather than stopping everyone else's refresh."""
+    codes = []
+    for user in list_user_ids():
+        try:
+            codes.extend(await user_codes(user))
+        except (*NETWORK_ERRORS, ValueError) as error:
+            print(f"Skipping symbols of user {user}: {error}")
+    return list(dict.fromkeys(codes))
+
+
+async def refresh_prices(codes: list[str] | None = None, ahead: int = REFRESH_AHEAD) -> None:
+    """Re-fetch everything the summary and own list tables need that expires within `ahead` seconds,
+    a few symbols at a time so a large watch list does not burst the upstream API."""
+    if codes is None:
+        codes = await tracked_codes()
+    for start in range(0, len(codes), REFRESH_BATCH_SIZE):
+        await asyncio.sleep(random.uniform(0, REFRESH_JITTER))
+        await prefetch_prices(codes[start:start + REFRESH_BATCH_SIZE], ahead=ahead)
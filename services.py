@@ -1,20 +1,28 @@
-import requests
-from typing import Literal
-
-from tinydb import Query
-
-from constant import TIME_OUT, get_url
-from db import db, insert_price_record, get_price_record, get_stock_account_id_record, insert_stock_account_id_record
+import asyncio
+import sys
+import time
+from typing import Any, Awaitable, Callable, Literal, Iterable
+
+from api import get, get_json, NETWORK_ERRORS
+from constant import REALTIME_LIST_KEYS, REALTIME_SYMBOL_KEYS, REALTIME_PRICE_KEYS, CHART_TYPE, HISTORY_CHART_TYPE, \
+    HISTORY_TAIL_TYPE, DEFAULT_USER, COMMAND_BUDGET, get_url
+from db import insert_price_record, get_price_record, get_stock_account_id_record, insert_stock_account_id_record, \
+    get_user_setting, set_user_setting, record_expired
 from auth import get_auth_headers
-from utils import convert_date_to_timestamp, now, expiry_plus
-from type import PriceRecord, PriceReturn, OwnStock, PriceLength
+from history import PriceSeries, HistoryStore
+from market import next_session_close
+from metrics import metrics
+from utils import now, expiry_plus
+from type import PriceRecord, PriceReturn, OwnStock, PriceLength, PriceType
 
+history_store = HistoryStore()
 
-def fetch_watch_list() -> set[str]:
+
+@metrics.timed('services.fetch_watch_list')
+async def fetch_watch_list(user: int = DEFAULT_USER) -> set[str]:
     url = get_url('watch_list', auth=True)
-    headers = get_auth_headers()
-    response = requests.get(url, headers=headers, timeout=TIME_OUT)
-    parsed = response.json()
+    headers = await get_auth_headers(user)
+    parsed = await get_json(url, headers=headers)
     watch_lists = parsed.get('d', [])
     if not bool(watch_lists):
         raise ValueError("Invalid response")
@@ -26,16 +34,175 @@ def fetch_watch_list() -> set[str]:
     return {item for item in watch_list if item}
 
 
-def get_watch_list() -> list[str]:
-    watch_list = db.table('settings').search(Query().name == 'watch_list')
-    if watch_list:
-        watch_list = watch_list[0]['value']
+async def get_watch_list(user: int = DEFAULT_USER) -> list[str]:
+    watch_list = get_user_setting('watch_list', user) or []
     if len(watch_list) == 0:
-        watch_list = fetch_watch_list()
-        db.table('settings').update({'name': 'watch_list', 'value': list(watch_list)})
+        watch_list = list(await fetch_watch_list(user))
+        set_user_setting('watch_list', watch_list, user)
     return watch_list
 
 
+@metrics.timed('services.fetch_price_history')
+async def fetch_price_history(code: str, chart_type: str) -> PriceSeries:
+    url = get_url('price_chart').format(code=code, type=chart_type)
+    return await get(url, parse=PriceSeries.from_body)
+
+
+async def get_price_series(code: str, chart_type: str) -> PriceSeries:
+    """Served from the per-symbol history store: the first request downloads the longest chart
+    (HISTORY_CHART_TYPE), later ones only merge a HISTORY_TAIL_TYPE tail in once the stored series is stale."""
+    if history_store.covers(code, chart_type):
+        if history_store.fresh(code):
+            return history_store.get(code)
+        if history_store.mergeable(code, HISTORY_TAIL_TYPE):
+            return history_store.merge(code, await fetch_price_history(code, HISTORY_TAIL_TYPE))
+
+    span = longest_chart_type([chart_type, HISTORY_CHART_TYPE])
+    return history_store.put(code, await fetch_price_history(code, span), span)
+
+
+@metrics.timed('services.fetch_realtime_prices')
+async def fetch_realtime_prices(codes: Iterable[str]) -> dict[str, float]:
+    """One request for every symbol, returns raw (unformatted) prices keyed by symbol.
+    Symbols missing from the result are counted, callers fall back to 1W charts for them."""
+    codes = sorted(set(codes))
+    if not codes:
+        return {}
+    url = get_url('realtime_price').format(code=','.join(codes))
+    parsed = await get_json(url)
+    prices = parse_realtime_prices(parsed, codes)
+    if len(prices) < len(codes):
+        metrics.count('realtime.missing', len(codes) - len(prices))
+    return prices
+
+
+def parse_realtime_prices(parsed: Any, codes: list[str]) -> dict[str, float]:
+    """The item list is the body itself or under REALTIME_LIST_KEYS, each item names its symbol under
+    REALTIME_SYMBOL_KEYS and its price under REALTIME_PRICE_KEYS. A non-empty response in any other shape
+    is reported on stderr with its keys, instead of quietly yielding nothing."""
+    if isinstance(parsed, list):
+        items = parsed
+    elif isinstance(parsed, dict):
+        items = next((parsed[key] for key in REALTIME_LIST_KEYS if isinstance(parsed.get(key), list)), [])
+    else:
+        items = []
+    prices = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        code = next((item[key] for key in REALTIME_SYMBOL_KEYS if item.get(key)), None)
+        price = next((item[key] for key in REALTIME_PRICE_KEYS if item.get(key)), None)
+        if code in codes and price is not None:
+            prices[code] = price
+
+    if parsed and not prices:
+        sample = items[0] if items else parsed
+        keys = sorted(sample) if isinstance(sample, dict) else type(sample).__name__
+        metrics.count('realtime.unparsed')
+        print(f'getPriceByList response has no prices in a known shape, keys: {keys}', file=sys.stderr)
+    return prices
+
+
+def needs_refresh(record: PriceRecord | None, ahead: int = 0) -> bool:
+    return not record or record_expired(record, ahead)
+
+
+def plan_chart_fetches(codes: Iterable[str], lengths: Iterable[str], ahead: int = 0) -> set[tuple[str, str]]:
+    """Every (code, chart type) download needed to serve root, min and max prices from the db
+    for at least the next `ahead` seconds."""
+    fetches = set()
+    for code in codes:
+        if not get_price_record(code, 'root', None) or not get_price_record(code, 'sub root', None):
+            fetches.add((code, '1M'))
+        for length in lengths:
+            if needs_refresh(get_price_record(code, 'min', length), ahead) \
+                    or needs_refresh(get_price_record(code, 'max', length), ahead):
+                fetches.add((code, length))
+    return fetches
+
+
+def longest_chart_type(chart_types: Iterable[str]) -> str:
+    return max(chart_types, key=list(CHART_TYPE).index)
+
+
+async def fetch_charts(fetches: Iterable[tuple[str, str]]) -> dict[tuple[str, str], PriceSeries | Exception]:
+    fetches = list(fetches)
+    results = await asyncio.gather(*(get_price_series(*fetch) for fetch in fetches), return_exceptions=True)
+    return dict(zip(fetches, results))
+
+
+@metrics.timed('services.prefetch_prices')
+async def prefetch_prices(codes: Iterable[str], lengths: Iterable[str] = ('3M', '1Y', '3Y'), ahead: int = 0) -> None:
+    """Warm the db for a whole table: last prices in one batched request, charts concurrently.
+    Records expiring within `ahead` seconds are refreshed too. Every window is sliced from the symbol's
+    stored history, so at most one chart download per symbol is needed.
+    Failed downloads are left out so the regular getters retry them and raise as before."""
+    codes, lengths = list(dict.fromkeys(codes)), list(lengths)
+    missing_last = [code for code in codes if needs_refresh(get_price_record(code, 'last', None), ahead)]
+    fetches = plan_chart_fetches(codes, lengths, ahead)
+
+    try:
+        realtime = await fetch_realtime_prices(missing_last)
+    except (*NETWORK_ERRORS, ValueError):
+        realtime = {}
+    for code, price in realtime.items():
+        save_last_price(code, format_price(price))
+    fetches.update((code, '1W') for code in missing_last if code not in realtime)
+
+    needed: dict[str, set[str]] = {}
+    for code, chart_type in fetches:
+        needed.setdefault(code, set()).add(chart_type)
+    longest = {(code, longest_chart_type(chart_types)) for code, chart_types in needed.items()}
+
+    for (code, _), series in (await fetch_charts(longest)).items():
+        if isinstance(series, Exception):
+            continue
+        try:
+            for chart_type in needed[code]:
+                if chart_type == '1W':
+                    await fetch_last_price_and_save(code, series)
+                elif chart_type == '1M':
+                    await init_root_price(code, series)
+                else:
+                    await refresh_min_max_price(code, chart_type, series)
+        except ValueError as error:
+            # one bad chart keeps that symbol's old records, the rest of the table is still refreshed
+            print(f'Prefetch skipped {code}: {error}', file=sys.stderr)
+
+
+async def finish_refresh(refresh: Awaitable) -> bool:
+    """Await a prefetch_prices started for a table, False when it failed and the table keeps its stale prices."""
+    try:
+        await refresh
+    except (*NETWORK_ERRORS, ValueError) as error:
+        print(f'Refresh failed, serving stale prices: {error}', file=sys.stderr)
+        return False
+    return True
+
+
+def budget_left(started: float) -> float:
+    """Seconds left of the COMMAND_BUDGET of a command that started at `started` (time.monotonic())."""
+    return max(0.0, started + COMMAND_BUDGET - time.monotonic())
+
+
+async def refresh_within_budget(codes: list[str], started: float) -> asyncio.Future | None:
+    """Refresh the prices of `codes` while the budget lasts. None when that was enough, otherwise the
+    refresh still running: pass it to revalidate once the table with the stale prices is posted."""
+    refresh = asyncio.ensure_future(prefetch_prices(codes))
+    done, _ = await asyncio.wait({refresh}, timeout=budget_left(started))
+    if done:
+        await finish_refresh(refresh)
+        return None
+    metrics.count('command.over_budget')
+    return refresh
+
+
+async def revalidate(refresh: Awaitable, update: Callable[[], Awaitable[None]]) -> None:
+    """Await a refresh that outran the budget, then `update` the posted table unless it failed."""
+    if await finish_refresh(refresh):
+        await update()
+
+
 def determine_root_and_sub_price(root: float, sub: float, last: float) -> tuple[float, float]:
     # return root, sub
     if sub == last: # cache
@@ -48,13 +215,20 @@ def determine_root_and_sub_price(root: float, sub: float, last: float) -> tuple[
     return sub, last
 
 
-def get_root_price(code: str) -> float:
+async def get_root_price(code: str) -> float:
+    last_price = await get_last_price(code)
+    root = advance_root_price(code, last_price)
+    if root is None:
+        root, _ = await init_root_price(code)
+    return root
+
+
+def advance_root_price(code: str, last_price: float) -> float | None:
+    """Move the stored root/sub root along with a new last price, None when they were never initialised."""
     root_record: PriceRecord = get_price_record(code=code, price_type='root', length=None)
     sub_root_record: PriceRecord = get_price_record(code=code, price_type='sub root', length=None)
-    last_price = get_last_price(code)
     if not root_record or not sub_root_record:
-        root, _ = init_root_price(code)
-        return root
+        return None
 
     root, sub_root = determine_root_and_sub_price(root_record['price'], sub_root_record['price'], last_price)
     if not root == root_record['price']:
@@ -65,7 +239,7 @@ def get_root_price(code: str) -> float:
     return root
 
 
-def init_root_price(code: str) -> tuple[float, float]:
+async def init_root_price(code: str, series: PriceSeries | None = None) -> tuple[float, float]:
     """Example: root = None, sub_root = None, prices = [10, 20, 30, 25, 20, 36], return root = 20 and sub_root = 36
         Explain:
         value - root - sub_root
@@ -76,103 +250,103 @@ def init_root_price(code: str) -> tuple[float, float]:
         20    - 30   - 20
         36    - 20   - 36
     """
-    url = get_url('price_chart').format(code=code, type='1M')
-    response = requests.get(url, timeout=TIME_OUT)
-    parsed = response.json()
-
-    prices = parsed.get('PriceHistory', [])
-    prices.sort(key=lambda x: convert_date_to_timestamp(x.get('TradingDate')))
-    if not bool(prices):
-        raise ValueError("Invalid response: PriceHistory is empty")
-
-    prices_value = [price.get('ClosePrice') for price in prices]
-    root, sub_root = None, None
-    for value in prices_value:
-        if value is None:
-            raise ValueError("Invalid response: ClosePrice is missing")
-
-        if not root:
-            root = value
-            continue
-        if not sub_root:
-            sub_root = value
-            continue
-        root, sub_root = determine_root_and_sub_price(root, sub_root, value)
+    if series is None:
+        series = await get_price_series(code, '1M')
+    root, sub_root = series.window('1M').root_and_sub_root()
 
     root = format_price(root)
     sub_root = format_price(sub_root)
-    db.table('prices').insert_multiple([
-        {'code': code, 'price': root, 'type': 'root'},
-        {'code': code, 'price': sub_root, 'type': 'sub root'}
-    ])
+    insert_price_record(code, None, {'expiry': None, 'price': root}, 'root')
+    insert_price_record(code, None, {'expiry': None, 'price': sub_root}, 'sub root')
     return root, sub_root
 
 
-def fetch_last_price_and_save(code: str) -> PriceRecord:
-    url = get_url('price_chart').format(code=code, type='1W')
-    response = requests.get(url, timeout=TIME_OUT)
-    parsed = response.json()
-
-    prices = parsed.get('PriceHistory', [])
-    if not bool(prices):
-        raise ValueError("Invalid response: PriceHistory is empty")
+@metrics.timed('services.fetch_last_price_and_save')
+async def fetch_last_price_and_save(code: str, series: PriceSeries | None = None) -> PriceRecord:
+    if series is None:
+        series = await get_price_series(code, '1W')
+    return save_last_price(code, format_price(series.last))
 
-    prices.sort(key=lambda x: convert_date_to_timestamp(x.get('TradingDate')))
-    last_price = prices[-1].get('ClosePrice')
-    if last_price is None:
-        raise ValueError("Invalid response: ClosePrice is missing")
 
+def save_last_price(code: str, last_price: float) -> PriceRecord:
     return insert_price_record(code, None, {
         'expiry': now() + expiry_plus('end_day'),
-        'price': format_price(last_price)
+        'price': last_price
     }, 'last')
 
 
-def get_last_price(code: str) -> float:
-    last_price: PriceRecord = get_price_record(code=code, price_type='last', length=None) or fetch_last_price_and_save(code)
+async def get_last_price(code: str) -> float:
+    last_price: PriceRecord = get_price_record(code=code, price_type='last', length=None) or await fetch_last_price_and_save(code)
     return last_price['price']
 
 
-def fetch_min_max_price(code: str, length: Literal['3M', '1Y', '3Y']) -> tuple[PriceReturn, PriceReturn]:
-    url = get_url('price_chart').format(code=code, type=length)
-    response = requests.get(url, timeout=TIME_OUT)
-    parsed = response.json()
+async def price_summary(code: str, lengths: Iterable[str] = ('3M', '1Y', '3Y')) -> dict[str, str | float]:
+    """Everything the tables show for one symbol: last and root price, then min_<length> / max_<length>."""
+    summary = {'code': code, 'last': await get_last_price(code), 'root': await get_root_price(code)}
+    for length in lengths:
+        summary[f'min_{length.lower()}'], summary[f'max_{length.lower()}'] = await get_min_max_price(code, length)
+    return summary
+
+
+def price_snapshot(code: str, lengths: Iterable[str] = ('3M', '1Y', '3Y')) -> dict[str, Any]:
+    """price_summary read from the db alone, never waiting on the network: expired values are used and their
+    keys listed under 'stale', values never fetched are None."""
+    snapshot = {'code': code, 'stale': set()}
+
+    def read(key: str, price_type: PriceType, length: str | None = None) -> None:
+        record = get_price_record(code, price_type, length, allow_stale=True)
+        snapshot[key] = record['price'] if record else None
+        if record and record.get('stale'):
+            snapshot['stale'].add(key)
+
+    read('last', 'last')
+    if snapshot['last'] is not None and 'last' not in snapshot['stale']:
+        advance_root_price(code, snapshot['last'])
+    read('root', 'root')
+    for length in lengths:
+        read(f'min_{length.lower()}', 'min', length)
+        read(f'max_{length.lower()}', 'max', length)
+    return snapshot
+
+
+async def watch_list_summary(user: int = DEFAULT_USER) -> list[dict[str, str | float]]:
+    watch_list = await get_watch_list(user)
+    await prefetch_prices(watch_list)
+    return [await price_summary(code) for code in watch_list]
 
-    prices = parsed.get('PriceHistory', [])
-    if not bool(prices):
-        raise ValueError("Invalid response")
 
-    max_value, min_value = float('-inf'), float('inf')
-    date_of_max, date_of_min = None, None
-    for price in prices:
-        close_price = price.get('ClosePrice')
-        trading_date = price.get('TradingDate')
-        if close_price is None or trading_date is None:
-            missing_key = 'ClosePrice' if close_price is None else 'TradingDate'
-            raise ValueError(f"Invalid response key: {missing_key}")
+async def own_list_summary(user: int = DEFAULT_USER) -> list[dict[str, str | float]]:
+    """Each held stock with its price_summary."""
+    own_list = await get_own_list(user)
+    await prefetch_prices([stock['code'] for stock in own_list])
+    return [{**stock, **await price_summary(stock['code'])} for stock in own_list]
 
-        if close_price > max_value:
-            max_value, date_of_max = close_price, trading_date
-        if close_price < min_value:
-            min_value, date_of_min = close_price, trading_date
+
+@metrics.timed('services.fetch_min_max_price')
+async def fetch_min_max_price(code: str, length: Literal['3M', '1Y', '3Y'],
+                              series: PriceSeries | None = None) -> tuple[PriceReturn, PriceReturn]:
+    if series is None:
+        series = await get_price_series(code, length)
+    (date_of_min, min_value), (date_of_max, max_value) = series.window(length).extremes()
 
     max_price: PriceReturn = {
-        'expiry': convert_date_to_timestamp(date_of_max) + expiry_plus(length),
+        'expiry': next_session_close(date_of_max + expiry_plus(length)),
         'price': format_price(max_value)
     }
     min_price: PriceReturn = {
-        'expiry': convert_date_to_timestamp(date_of_min) + expiry_plus(length),
+        'expiry': next_session_close(date_of_min + expiry_plus(length)),
         'price': format_price(min_value)
     }
 
     return min_price, max_price
 
 
-def get_min_max_price(code: str, length: Literal['3M', '1Y', '3Y']) -> tuple[float, float]:
+async def get_min_max_price(code: str, length: Literal['3M', '1Y', '3Y'],
+                            series: PriceSeries | None = None) -> tuple[float, float]:
     min_price: PriceRecord = get_price_record(code, 'min', length)
     max_price: PriceRecord = get_price_record(code, 'max', length)
     if not min_price or not max_price:
-        f_min_price, f_max_price = fetch_min_max_price(code, length)
+        f_min_price, f_max_price = await fetch_min_max_price(code, length, series)
         if not min_price or f_min_price['price'] < min_price['price']:
             min_price = insert_price_record(code, length, f_min_price, 'min')
         if not max_price or f_max_price['price'] > max_price['price']:
@@ -181,15 +355,33 @@ def get_min_max_price(code: str, length: Literal['3M', '1Y', '3Y']) -> tuple[flo
     return min_price['price'], max_price['price']
 
 
+async def refresh_min_max_price(code: str, length: Literal['3M', '1Y', '3Y'],
+                                series: PriceSeries | None = None) -> tuple[PriceRecord, PriceRecord]:
+    f_min_price, f_max_price = await fetch_min_max_price(code, length, series)
+    return insert_price_record(code, length, f_min_price, 'min'), insert_price_record(code, length, f_max_price, 'max')
+
+
+def advance_min_max_price(code: str, last_price: float, lengths: Iterable[str] = ('3M', '1Y', '3Y')) -> None:
+    """A tick beyond a stored extreme becomes the new extreme right away, valid for a full window from today."""
+    for length in lengths:
+        expiry = next_session_close(now() + expiry_plus(length))
+        min_record = get_price_record(code, 'min', length)
+        max_record = get_price_record(code, 'max', length)
+        if min_record and last_price < min_record['price']:
+            insert_price_record(code, length, {'expiry': expiry, 'price': last_price}, 'min')
+        if max_record and last_price > max_record['price']:
+            insert_price_record(code, length, {'expiry': expiry, 'price': last_price}, 'max')
+
+
 def format_price(price: float) -> float:
     return round(price / 1000, 2)
 
 
-def fetch_account_id() -> int:
+@metrics.timed('services.fetch_account_id')
+async def fetch_account_id(user: int = DEFAULT_USER) -> int:
     url = get_url('account_list', auth=True)
-    headers = get_auth_headers()
-    res = requests.get(url, headers=headers, timeout=TIME_OUT)
-    parsed = res.json()
+    headers = await get_auth_headers(user)
+    parsed = await get_json(url, headers=headers)
     accounts = parsed.get('d')
     if not bool(accounts):
         raise ValueError("Invalid response")
@@ -201,22 +393,22 @@ def fetch_account_id() -> int:
     if not stock_account_id:
         raise ValueError("Invalid response")
 
-    insert_stock_account_id_record(stock_account_id)
+    insert_stock_account_id_record(stock_account_id, user)
     return stock_account_id
 
-def get_stock_account_id() -> int | None:
-    account_id = get_stock_account_id_record()
+async def get_stock_account_id(user: int = DEFAULT_USER) -> int | None:
+    account_id = get_stock_account_id_record(user)
     if not account_id:
-        account_id = fetch_account_id()
+        account_id = await fetch_account_id(user)
 
     return account_id
 
 
-def fetch_and_save_own_list() -> list[OwnStock]:
-    url = get_url('own_list', auth=True).format(account_id=get_stock_account_id())
-    headers = get_auth_headers()
-    response = requests.get(url, headers=headers, timeout=TIME_OUT)
-    parsed = response.json()
+@metrics.timed('services.fetch_and_save_own_list')
+async def fetch_and_save_own_list(user: int = DEFAULT_USER) -> list[OwnStock]:
+    url = get_url('own_list', auth=True).format(account_id=await get_stock_account_id(user))
+    headers = await get_auth_headers(user)
+    parsed = await get_json(url, headers=headers)
     data = parsed.get('d', [])
     if not bool(data):
         raise ValueError("Invalid response")
@@ -236,18 +428,16 @@ def fetch_and_save_own_list() -> list[OwnStock]:
         }
         own_list.append(own_stock)
 
-    db.table('settings').update({'name': 'own_list', 'value': own_list, 'expiry': now() + expiry_plus('end_day')})
+    set_user_setting('own_list', own_list, user, now() + expiry_plus('end_day'))
     return own_list
 
-def get_own_list() -> list[OwnStock]:
-    own_list = db.table('settings').search(Query().name == 'own_list')
+async def get_own_list(user: int = DEFAULT_USER) -> list[OwnStock]:
+    own_list = get_user_setting('own_list', user)
     if not own_list:
-        own_list = fetch_and_save_own_list()
-    else:
-        own_list = own_list[0]['value']
+        own_list = await fetch_and_save_own_list(user)
     return own_list
 
 
 if __name__ == '__main__':
-    print(get_root_price('VNM'))
+    print(asyncio.run(get_root_price('VNM')))
     pass
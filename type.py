@@ -1,4 +1,10 @@
-from typing import TypedDict, Literal, Optional
+from typing import TypedDict, Literal, Optional, NotRequired
+
+
+class User(TypedDict):
+    id: int
+    username: str
+    password: str
 
 
 class AuthToken(TypedDict):
@@ -16,6 +22,8 @@ class PriceRecord(TypedDict):
     type: PriceType
     expiry: int | None
     length: Optional[PriceLength]
+    # set on expired records served by get_price_record(..., allow_stale=True)
+    stale: NotRequired[bool]
 
 
 class OwnStock(TypedDict):
@@ -28,3 +36,24 @@ class OwnStock(TypedDict):
 class PriceReturn(TypedDict):
     expiry: int | None
     price: float
+
+
+class HistoryRecord(TypedDict):
+    code: str
+    span: str
+    refreshed: int
+    expiry: int
+
+
+AlertKind = Literal['near_max', 'near_min', 'below_buy', 'reversal']
+
+
+class AlertRule(TypedDict):
+    id: int
+    code: Optional[str]
+    kind: AlertKind
+    length: Optional[PriceLength]
+    threshold: Optional[float]
+    # guild whose channel gets the alert (None: DISCORD_TEST_CHANNEL_ID), user whose holdings below_buy reads
+    guild_id: Optional[int]
+    user_id: int
@@ -2,6 +2,8 @@ import time
 from datetime import datetime
 from typing import Optional, Literal
 
+from market import next_price_change
+
 
 def safe_access(data, keys) -> Optional:
     result = data
@@ -22,19 +24,21 @@ def convert_date_to_timestamp(date: str) -> int:
     return int(datetime_obj.timestamp())
 
 
-def expiry_plus(length: Literal['3M', '1Y', 'end_day', '3Y', '1M']) -> int:
+def expiry_plus(length: Literal['3M', '1Y', 'end_day', '3Y', '1M', '1W']) -> int:
     if length == '3M':
         expiry = 90 * 24 * 3600
     elif length == '1Y':
         expiry = 365 * 24 * 3600
     elif length == 'end_day':
-        current = datetime.now()
-        end_day = datetime(current.year, current.month, current.day, 23, 59, 59)
-        expiry = int((end_day - current).total_seconds())
+        # until today's closing bell during a trading day, after it until the next session opens
+        current = now()
+        expiry = next_price_change(current) - current
     elif length == '3Y':
         expiry = 3 * 365 * 24 * 3600
     elif length == '1M':
         expiry = 30 * 24 * 3600
+    elif length == '1W':
+        expiry = 7 * 24 * 3600
     else:
         raise ValueError("Invalid length")
     return expiry